@@ -0,0 +1,79 @@
+""" RealDolos' funky volafile upload tool (Rate limit tests)"""
+
+import time
+
+import pytest
+
+from volaupload.limit import parse_clock
+from volaupload.limit import parse_rate
+from volaupload.limit import Schedule
+
+
+def at(hour, minute=0):
+    """Seconds since the epoch of a local time of day"""
+    return time.mktime((2024, 3, 4, hour, minute, 0, 0, 0, -1))
+
+
+@pytest.mark.parametrize("value,rate", [
+    ("0", 0),
+    ("off", 0),
+    ("Unlimited", 0),
+    ("512K", 512 << 10),
+    ("2M", 2 << 20),
+    ("1.5MiB", 3 << 19),
+    (4096, 4096),
+])
+def test_parse_rate(value, rate):
+    """Rates are sizes, or some way of saying no limit"""
+    assert parse_rate(value) == rate
+
+
+@pytest.mark.parametrize("value,minutes", [("0", 0), ("9", 540), ("17:30", 1050), ("24", 1440)])
+def test_parse_clock(value, minutes):
+    """Times of day are hours and optional minutes"""
+    assert parse_clock(value) == minutes
+
+
+@pytest.mark.parametrize("value", ["25", "12:60", "-1", "noon"])
+def test_bad_clock(value):
+    """Times out of range or not times at all are errors"""
+    with pytest.raises(ValueError):
+        parse_clock(value)
+
+
+def test_plain_rate():
+    """A rate without times applies all day"""
+    schedule = Schedule("2M")
+    assert [schedule.rate(at(h)) for h in (0, 12, 23)] == [2 << 20] * 3
+    assert str(schedule) == "2M"
+
+
+def test_business_hours():
+    """Ranges include their start, but not their end"""
+    schedule = Schedule("9-18=2M,0")
+    assert schedule.rate(at(8, 59)) == 0
+    assert schedule.rate(at(9)) == 2 << 20
+    assert schedule.rate(at(17, 59)) == 2 << 20
+    assert schedule.rate(at(18)) == 0
+
+
+def test_past_midnight():
+    """Ranges may span midnight, and the first matching range wins"""
+    schedule = Schedule("22-6=1M, 5-7=3M, 5M")
+    assert schedule.rate(at(23)) == 1 << 20
+    assert schedule.rate(at(0)) == 1 << 20
+    assert schedule.rate(at(5, 30)) == 1 << 20
+    assert schedule.rate(at(6, 30)) == 3 << 20
+    assert schedule.rate(at(12)) == 5 << 20
+
+
+def test_no_default():
+    """Outside all ranges there is no limit, unless a default is given"""
+    assert Schedule("9-18=2M").rate(at(20)) == 0
+
+
+@pytest.mark.parametrize("spec", ["9=2M", "9-25=2M", "9-18=fast"])
+def test_bad_schedule(spec):
+    """Broken schedules are errors"""
+    with pytest.raises(ValueError):
+        Schedule(spec)
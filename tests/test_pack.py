@@ -0,0 +1,101 @@
+""" RealDolos' funky volafile upload tool (Archive packing tests)"""
+
+import io
+import os
+import tarfile
+
+import pytest
+
+from volaupload.discover import FileRecord
+from volaupload.pack import TarStream
+
+NAMES = [
+    "short.txt",
+    "empty",
+    "block.bin",
+    os.path.join("deep" * 10, "long" * 30 + ".bin"),
+    os.path.join("ünïcödé", "日本語のファイル名.txt"),
+]
+
+
+@pytest.fixture
+def members(tmp_path):
+    """Files with long, non-ASCII and awkwardly sized contents"""
+    sizes = [1000, 0, tarfile.BLOCKSIZE, 3 * tarfile.BLOCKSIZE + 1, 77]
+    records = []
+    for num, (name, size) in enumerate(zip(NAMES, sizes)):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(bytes((num + i) % 251 for i in range(size)))
+        os.utime(path, (1500000000 + num, 1500000000 + num))
+        records.append(FileRecord.stat(path))
+    return tmp_path, records
+
+
+def read_all(stream, chunk):
+    """Read a stream to the end, chunk bytes at a time"""
+    data = bytearray()
+    while True:
+        cur = stream.read(chunk)
+        if not cur:
+            return bytes(data)
+        data += cur
+
+
+def reference(base, records):
+    """The same archive, as written by tarfile"""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w", format=tarfile.PAX_FORMAT,
+                      encoding="utf-8") as tar:
+        for record in records:
+            info = tarfile.TarInfo(os.path.relpath(record.path, base).replace(os.sep, "/"))
+            info.size = record.size
+            info.mtime = int(record.mtime)
+            info.mode = 0o644
+            with open(record.path, "rb") as filep:
+                tar.addfile(info, filep)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("chunk", [1, 100, tarfile.BLOCKSIZE, 1 << 20])
+def test_matches_tarfile(members, chunk):
+    """Streams are byte for byte what tarfile writes"""
+    base, records = members
+    with TarStream("pack", records, str(base)) as stream:
+        data = read_all(stream, chunk)
+        assert len(data) == stream.size
+    assert data == reference(base, records)
+
+
+def test_layout(members):
+    """Headers and member data start where the layout says"""
+    base, records = members
+    with TarStream("pack", records, str(base)) as stream:
+        data = read_all(stream, 1 << 20)
+        assert stream.size % tarfile.RECORDSIZE == 0
+        with tarfile.open(fileobj=io.BytesIO(data), encoding="utf-8") as tar:
+            infos = tar.getmembers()
+            assert [i.name for i in infos] == [n.replace(os.sep, "/") for n in NAMES]
+            assert [i.offset for i in infos] == stream.starts
+            assert [i.offset_data for i in infos] == [
+                s + h for s, h in zip(stream.starts, stream.headers)]
+            for info, record in zip(infos, records):
+                with open(record.path, "rb") as filep:
+                    assert tar.extractfile(info).read() == filep.read()
+
+
+def test_seek(members):
+    """Reading after seeking anywhere continues the same archive"""
+    base, records = members
+    whole = reference(base, records)
+    with TarStream("pack", records, str(base)) as stream:
+        assert stream.seek(0, os.SEEK_END) == len(whole)
+        assert stream.read(10) == b""
+        for offset in [0, 1, 511, 512, 700, *stream.starts, len(whole) - 1]:
+            assert stream.seek(offset) == offset
+            assert read_all(stream, 333) == whole[offset:]
+        stream.seek(100)
+        assert stream.seek(-50, os.SEEK_CUR) == 50
+        assert stream.read(10) == whole[50:60]
+        with pytest.raises(ValueError):
+            stream.seek(-1)
@@ -0,0 +1,76 @@
+""" RealDolos' funky volafile upload tool (Retry tests)"""
+
+import json
+
+import pytest
+
+from volaupload.retry import backoff
+from volaupload.retry import BACKOFF_CAP
+from volaupload.retry import fatal
+from volaupload.retry import retryable
+from volaupload.retry import Stalled
+
+
+class HTTPError(Exception):
+    """Like requests' errors, with a response"""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.response = type("Response", (), dict(status_code=status))()
+
+
+def bad_json():
+    """What json raises on an HTML error page"""
+    try:
+        json.loads("<html>502 Bad Gateway</html>")
+    except ValueError as ex:
+        return ex
+    raise AssertionError("json parsed HTML")
+
+
+@pytest.mark.parametrize("ex", [
+    FileNotFoundError(2, "No such file"),
+    IsADirectoryError(21, "Is a directory"),
+    NotADirectoryError(20, "Not a directory"),
+    PermissionError(13, "Permission denied"),
+    ValueError("File must be at most 20 GB"),
+    HTTPError(403),
+    HTTPError(404),
+])
+def test_not_retryable(ex):
+    """Retrying does not fix these"""
+    assert not retryable(ex)
+
+
+@pytest.mark.parametrize("ex", [
+    ConnectionError("reset"),
+    TimeoutError("timed out"),
+    OSError(5, "Input/output error"),
+    Stalled("stalled"),
+    bad_json(),
+    ValueError("Expecting value"),
+    HTTPError(408),
+    HTTPError(429),
+    HTTPError(500),
+    HTTPError(503),
+])
+def test_retryable(ex):
+    """These might go away"""
+    assert retryable(ex)
+
+
+def test_fatal():
+    """Only permanent errors are fatal, whatever the status"""
+    assert fatal(PermissionError(13, "Permission denied"))
+    assert fatal(ValueError("File must be at most 1 GB"))
+    assert not fatal(bad_json())
+    assert not fatal(HTTPError(404))
+
+
+@pytest.mark.parametrize("attempt", [0, 1, 5, 100])
+def test_backoff(attempt):
+    """Backoff grows exponentially with jitter, up to the cap"""
+    limit = min(BACKOFF_CAP, 0.5 * (1 << attempt))
+    waits = [backoff(attempt, base=0.5) for _ in range(200)]
+    assert all(0 <= w <= limit for w in waits)
+    assert len(set(waits)) > 1
@@ -0,0 +1,153 @@
+""" RealDolos' funky volafile upload tool (Scheduling tests)"""
+
+import json
+import threading
+import time
+
+import pytest
+
+from volaupload.discover import FileRecord
+from volaupload.scheduler import Job
+from volaupload.scheduler import Policy
+from volaupload.scheduler import Tags
+from volaupload.scheduler import WorkQueue
+
+SIZES = [30, 10, 50, 20, 40]
+
+
+def jobs():
+    """A job per size, queued in that order"""
+    return [Job(FileRecord("/up/f{}".format(i), size), i) for i, size in enumerate(SIZES)]
+
+
+def drain(queue):
+    """Items of all jobs in the order they come out"""
+    queue.close()
+    items = []
+    while True:
+        job = queue.get()
+        if job is None:
+            return items
+        items.append(job.item)
+
+
+@pytest.fixture
+def tags(tmp_path):
+    """Tags prioritizing f3, and giving f1 and f4 deadlines"""
+    file = tmp_path / "tags.jsonl"
+    file.write_text("\n".join(json.dumps(t) for t in [
+        {"file": "/up/f3", "priority": 5},
+        {"file": "/up/f1", "deadline": 2000},
+        {"file": "/up/f4", "deadline": "1970-01-01T00:16:40+00:00"},
+    ]) + "\n# comment\n", encoding="utf-8")
+    return Tags(file)
+
+
+@pytest.mark.parametrize("policy,order", [
+    ("fifo", [0, 1, 2, 3, 4]),
+    ("shortest", [1, 3, 0, 4, 2]),
+    ("longest", [2, 4, 0, 3, 1]),
+])
+def test_policies(policy, order):
+    """Jobs come out in the order of the policy"""
+    assert drain(WorkQueue(jobs(), policy=Policy(policy))) == order
+
+
+@pytest.mark.parametrize("policy,order", [
+    ("fifo", [3, 0, 1, 2, 4]),
+    ("shortest", [3, 1, 0, 4, 2]),
+    ("priority", [3, 4, 1, 0, 2]),
+    ("deadline", [4, 1, 3, 0, 2]),
+])
+def test_tags(tags, policy, order):
+    """Priorities go first, deadlines break ties or go first themselves"""
+    assert drain(WorkQueue(jobs(), policy=Policy(policy, tags))) == order
+
+
+def test_glob_tags(tmp_path):
+    """Patterns match base names"""
+    file = tmp_path / "tags.jsonl"
+    file.write_text(json.dumps({"file": "*.nfo", "priority": 1}), encoding="utf-8")
+    tagged = Tags(file)
+    assert tagged.get("/x/y.nfo")[0] == 1
+    assert tagged.get("/x/y.mkv")[0] == 0
+
+
+def test_unknown_policy():
+    """Typos do not go unnoticed"""
+    with pytest.raises(ValueError):
+        Policy("random")
+
+
+def test_requeue_fifo_goes_last():
+    """Retries without delay line up behind what is queued already"""
+    queue = WorkQueue(jobs())
+    first = queue.get()
+    queue.requeue(first)
+    assert drain(queue) == [1, 2, 3, 4, 0]
+
+
+def test_requeue_delay():
+    """Delayed retries wait their turn, without blocking other jobs"""
+    queue = WorkQueue(jobs()[:2])
+    first = queue.get()
+    start = time.monotonic()
+    queue.requeue(first, 0.3)
+    assert queue.get().item == 1
+    assert time.monotonic() - start < 0.2
+    queue.close()
+    assert queue.get() is first
+    assert time.monotonic() - start >= 0.3
+    assert queue.get() is None
+
+
+def test_requeue_wakes_waiting_worker():
+    """Workers waiting for jobs pick up retries once due"""
+    queue = WorkQueue()
+    got = []
+    worker = threading.Thread(target=lambda: got.append(queue.get()))
+    worker.start()
+    job = jobs()[0]
+    start = time.monotonic()
+    queue.requeue(job, 0.2)
+    worker.join(5)
+    assert got == [job]
+    assert time.monotonic() - start >= 0.2
+
+
+def test_bounded_put():
+    """Bounded queues make producers wait for room"""
+    queue = WorkQueue(maxsize=1)
+    queue.put(jobs()[0])
+    done = threading.Event()
+
+    def producer():
+        queue.put(jobs()[1])
+        done.set()
+
+    threading.Thread(target=producer, daemon=True).start()
+    assert not done.wait(0.1)
+    assert queue.get().item == 0
+    assert done.wait(5)
+    assert len(queue) == 1
+
+
+def test_closed():
+    """Closed queues take no new jobs, but retries still"""
+    queue = WorkQueue(jobs()[:1])
+    queue.close()
+    with pytest.raises(ValueError):
+        queue.put(jobs()[1])
+    job = queue.get()
+    queue.requeue(job)
+    assert queue.get() is job
+    assert queue.get() is None
+
+
+def test_drop():
+    """Dropping empties the queue and closes it"""
+    queue = WorkQueue(jobs())
+    queue.requeue(queue.get(), 60)
+    assert queue.drop() == 5
+    assert len(queue) == 0
+    assert queue.get() is None
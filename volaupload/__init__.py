@@ -5,4 +5,13 @@
 from ._version import __version__
 from .main import main
 
-__all__ = ['__version__', 'main']
+__all__ = ['__version__', 'main', 'Uploader', 'UploadResult']
+
+
+def __getattr__(name):
+    # The library API pulls in asyncio, which the command line does not need
+    if name in ("Uploader", "UploadResult"):
+        from . import api
+
+        return getattr(api, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
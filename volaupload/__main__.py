@@ -3,6 +3,7 @@
 
 # pylint: disable=broad-except
 
+import os
 import sys
 
 from volaupload import main
@@ -10,17 +11,18 @@ from volaupload import main
 def run():
     """ Run as CLI command """
 
-    try:
-        import win_unicode_console
-        win_unicode_console.enable(use_unicode_argv=True)
-    except ImportError:
-        pass
-
-    try:
-        import colorama
-        colorama.init()
-    except ImportError:
-        pass
+    if os.name == "nt":
+        try:
+            import win_unicode_console
+            win_unicode_console.enable(use_unicode_argv=True)
+        except ImportError:
+            pass
+
+        try:
+            import colorama
+            colorama.init()
+        except ImportError:
+            pass
 
     import warnings
     warnings.simplefilter("ignore")
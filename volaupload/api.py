@@ -0,0 +1,275 @@
+""" RealDolos' funky volafile upload tool (Library API)"""
+
+# pylint: disable=broad-except
+
+import asyncio
+import io
+import os
+import threading
+import time
+
+from functools import partial
+
+from .discover import FileRecord
+from .journal import Journal
+from .limit import TokenBucket
+from .main import BLOCK_SIZE
+from .main import upload
+from .progress import Progress
+from .progress import Ticker
+from .readahead import default_strategy as default_readahead
+from .retry import backoff
+from .retry import retryable
+from .retry import set_timeout
+from .retry import StallWatchdog
+from .utils import cache_dir
+from .utils import Reader
+
+
+class StreamSource(Reader):
+    """Upload source reading size bytes of a caller's binary stream from
+    where it was when handed over, and leaving it open when done"""
+
+    def __init__(self, stream, start, size):
+        self.stream = stream
+        self.start = start
+        self.size = size
+        stream.seek(start)
+
+    def _seek(self, offset):
+        """Seek, relative to where the stream started"""
+        self.pos = self.stream.seek(self.start + offset) - self.start
+
+    def read(self, size=-1):
+        """Read from the stream"""
+        if size is None or size < 0 or size > self.size - self.pos:
+            size = max(0, self.size - self.pos)
+        data = self.stream.read(size)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        """The stream belongs to the caller"""
+        pass
+
+
+class UploadResult:
+    """What became of an upload"""
+
+    def __init__(self, name, file_id, size, room, server=None, resumes=0,
+                 attempts=1, stats=None):
+        self.name = name
+        self.file_id = file_id
+        self.size = size
+        self.room = room
+        self.server = server
+        self.resumes = resumes
+        self.attempts = attempts
+        self.stats = stats or dict()
+
+    def __repr__(self):
+        return "<UploadResult({!r}, {}, {})>".format(self.name, self.file_id, self.size)
+
+
+class Transfer:
+    """An upload, as seen from both the event loop and the worker thread
+    running it"""
+
+    def __init__(self, loop, hook):
+        self.loop = loop
+        self.hook = hook
+        self.callback = None
+        self.cancelled = threading.Event()
+
+    def __call__(self, callback):
+        """Called by the worker for every block, so keep it cheap"""
+        self.callback = callback
+        if self.cancelled.is_set():
+            callback.abort = asyncio.CancelledError("Upload cancelled")
+
+    def report(self, callback):
+        """Hand a snapshot of the upload to the loop"""
+        if not self.hook:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.hook, callback.snapshot())
+        except RuntimeError:
+            # Loop is gone already
+            pass
+
+    def cancel(self):
+        """Abort the upload at the next block, and do not retry it"""
+        self.cancelled.set()
+        callback = self.callback
+        if callback:
+            callback.abort = asyncio.CancelledError("Upload cancelled")
+
+
+class Uploader:
+    """Uploads files and streams to a room from asyncio code.
+
+    Uploads run on a pool of threads sharing one room session. Each
+    upload() resolves to an UploadResult, or raises once retrying did not
+    help. Instead of printing progress, hooks are called on the event loop
+    with snapshots of the upload.
+
+        async with Uploader("BEEPi", "someone") as uploader:
+            results = await uploader.upload_many(["a.jpg", b"bytes"])
+    """
+
+    def __init__(self, room, user=None, password=None, *, jobs=4,
+                 block_size=BLOCK_SIZE, resume=True, attempts=3, stall_time=60.0,
+                 stall_rate=4096, limit=None, on_progress=None):
+        self.owned = isinstance(room, str)
+        self.name = room if self.owned else room.name
+        self.room = None if self.owned else room
+        self.user = user
+        self.password = password
+        self.jobs = max(1, jobs)
+        self.block_size = block_size
+        self.resume = resume
+        self.attempts = max(1, attempts)
+        self.stall_time = stall_time
+        self.stall_rate = stall_rate
+        self.limiter = TokenBucket(limit) if limit else None
+        self.on_progress = on_progress
+        self.progress = Progress(0, 0)
+        self.journal = None
+        self.pool = None
+        self.ticker = None
+        self.closed = False
+        self.items = 0
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, _extype, _value, _traceback):
+        await self.close()
+
+    async def open(self):
+        """Enter the room, unless given an open one, and start the workers"""
+        if self.closed:
+            raise RuntimeError("Uploader is closed")
+        if self.pool:
+            return self
+        from concurrent.futures import ThreadPoolExecutor
+
+        loop = asyncio.get_running_loop()
+        if self.room is None:
+            from volapi import Room
+
+            self.room = await loop.run_in_executor(
+                None, partial(Room, self.name, self.user, subscribe=False))
+            if self.password:
+                try:
+                    await loop.run_in_executor(None, self.room.user.login, self.password)
+                except BaseException:
+                    self.room.close()
+                    self.room = None
+                    raise
+        if self.stall_time > 0:
+            self.progress.watchers.append(
+                StallWatchdog(self.stall_rate, self.stall_time).watch)
+            set_timeout(self.room.conn, self.stall_time)
+        if self.resume:
+            self.journal = Journal(os.path.join(cache_dir(), "journal.json"))
+        self.pool = ThreadPoolExecutor(self.jobs, thread_name_prefix="uploader")
+        self.progress.watchers.append(self.report)
+        self.ticker = Ticker(self.progress).start()
+        return self
+
+    async def close(self):
+        """Wait for the uploads still running, and leave the room if it was
+        entered by open()"""
+        if self.closed or not self.pool:
+            self.closed = True
+            return
+        self.closed = True
+        pool, self.pool = self.pool, None
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, partial(pool.shutdown, wait=True))
+        finally:
+            self.ticker.stop()
+            if self.journal:
+                self.journal.save(force=True)
+            if self.owned and self.room:
+                self.room.close()
+
+    def snapshot(self):
+        """Machine readable state of all uploads so far"""
+        return self.progress.snapshot()
+
+    @staticmethod
+    def report(callback):
+        """Hand progress of uploads in flight to their hooks, at the rate
+        of the ticker instead of for every block"""
+        if isinstance(callback.hook, Transfer):
+            callback.hook.report(callback)
+
+    async def upload(self, file, name=None, *, on_progress=None):
+        """Upload a path, bytes, or a seekable binary stream from where it
+        is now, optionally as name. on_progress is called with snapshots
+        of the upload while it is going up."""
+        if not self.pool:
+            raise RuntimeError("Uploader is {}".format("closed" if self.closed else "not open"))
+        loop = asyncio.get_running_loop()
+        transfer = Transfer(loop, on_progress or self.on_progress)
+        if isinstance(file, (bytes, bytearray, memoryview)):
+            file = io.BytesIO(file)
+        try:
+            return await loop.run_in_executor(self.pool, self.send, file, name, transfer)
+        except asyncio.CancelledError:
+            transfer.cancel()
+            raise
+
+    async def upload_many(self, files, *, on_progress=None, return_exceptions=False):
+        """Upload several files or streams at once, with results in order"""
+        return await asyncio.gather(
+            *(self.upload(file, on_progress=on_progress) for file in files),
+            return_exceptions=return_exceptions)
+
+    def send(self, file, name, transfer):
+        """Upload in a worker thread, retrying as often as allowed"""
+        stream = start = None
+        if hasattr(file, "read"):
+            stream = file
+            start = stream.tell()
+            size = stream.seek(0, os.SEEK_END) - start
+            name = name or os.path.basename(str(getattr(stream, "name", "") or ""))
+            file = FileRecord(name or "upload", size, time.time())
+        else:
+            file = FileRecord.stat(os.fspath(file))
+            if name:
+                file.name = name
+        with self.progress.lock:
+            self.progress.files += 1
+            self.progress.total += file.size
+            self.items += 1
+            item = self.items
+
+        attempt = 0
+        while True:
+            if transfer.cancelled.is_set():
+                raise asyncio.CancelledError("Upload cancelled")
+            attempt += 1
+            try:
+                file_id = upload(self.room, file, item, self.progress,
+                                 block_size=self.block_size,
+                                 readahead="none" if stream else default_readahead(),
+                                 journal=None if stream else self.journal,
+                                 limiter=self.limiter,
+                                 source=StreamSource(stream, start, file.size) if stream else None,
+                                 hook=transfer)
+                break
+            except Exception as ex:
+                if attempt >= self.attempts or not retryable(ex):
+                    raise
+                if transfer.cancelled.wait(backoff(attempt - 1)):
+                    raise asyncio.CancelledError("Upload cancelled")
+
+        transfer.report(transfer.callback)
+        snap = transfer.callback.snapshot()
+        return UploadResult(file.name, file_id, file.size, self.room.name,
+                            server=snap["server"], resumes=snap["resumes"],
+                            attempts=attempt, stats=transfer.callback.stat.snapshot(file.size))
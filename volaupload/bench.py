@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+""" RealDolos' funky volafile upload tool (Benchmarks)
+
+Runs reproducible upload scenarios against a local stand-in for vola's
+upload servers, and reports throughput and overhead as JSON:
+
+    python3 -m volaupload.bench [--scenario NAME] [--scale N] [--output FILE]
+"""
+
+# pylint: disable=broad-except
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+from ._version import __version__
+
+SCENARIOS = dict(
+    small=dict(files=400, size=32 << 10, jobs=4),
+    huge=dict(files=1, size=512 << 20),
+    latency=dict(files=32, size=2 << 20, jobs=4, latency=0.05, bandwidth=64 << 20),
+    failures=dict(files=4, size=64 << 20, fail_after=24 << 20),
+    startup=dict(runs=20),
+    )
+
+SEED_BLOCK = 1 << 20
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Just enough of vola's REST and upload endpoints"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        """Shut up"""
+        pass
+
+    def reply(self, obj, code=200):
+        """Send a JSON response"""
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay(self):
+        """Emulate round-trip latency"""
+        if self.server.options.get("latency"):
+            time.sleep(self.server.options["latency"])
+
+    def do_GET(self):
+        """REST calls"""
+        url = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.delay()
+        state = self.server.state
+        if url.path == "/rest/getUploadKey":
+            key = uuid.uuid4().hex
+            state["received"][key] = 0
+            self.reply(dict(key=key, server=self.server.name, file_id=key[:10]))
+        elif url.path == "/rest/uploadStatus":
+            self.reply(dict(receivedBytes=state["received"].get(params.get("key"), 0),
+                            ended=False))
+        elif url.path == "/rest/stats":
+            self.reply(dict((k, v) for k, v in state.items() if k != "received"))
+        else:
+            self.reply(dict(error="Unknown call"), 404)
+
+    def do_POST(self):
+        """Uploads, consuming the multipart body"""
+        url = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        options, state = self.server.options, self.server.state
+        key = params.get("key")
+        if url.path != "/upload" or key not in state["received"]:
+            self.reply(dict(error="Bad upload"), 400)
+            return
+        self.delay()
+        state["posts"] += 1
+        length = int(self.headers["Content-Length"])
+        boundary = self.headers["Content-Type"].split("boundary=", 1)[1]
+        trailer = len("\r\n--{}--\r\n".format(boundary))
+        start = int(params.get("startAt", 0))
+        fail_after = options.get("fail_after")
+        fail = fail_after and key not in state["failed"]
+        bandwidth = options.get("bandwidth")
+
+        remaining, preamble, payload = length, None, 0
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 1 << 20))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            if preamble is None:
+                preamble = chunk.find(b"\r\n\r\n") + 4
+                payload = -preamble
+            payload += len(chunk)
+            state["bytes"] += len(chunk)
+            received = start + max(0, min(payload, length - preamble - trailer))
+            state["received"][key] = received
+            if bandwidth:
+                time.sleep(len(chunk) / bandwidth)
+            if fail and received - start >= fail_after:
+                state["failed"][key] = True
+                state["aborted"] += 1
+                self.close_connection = True
+                self.connection.close()
+                return
+        self.reply(dict(ok=True))
+
+
+def serve(options, conn):
+    """Run the mock server, in its own process"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    server.daemon_threads = True
+    server.options = options
+    server.state = dict(received=dict(), failed=dict(), posts=0, aborted=0, bytes=0)
+    server.name = "127.0.0.1:{}".format(server.server_address[1])
+    conn.send(server.name)
+    server.serve_forever()
+
+
+class MockServer:
+    """A mock upload server running in a separate process, so that its
+    CPU time does not count towards ours"""
+
+    def __init__(self, **options):
+        parent, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, args=(options, child),
+                                               daemon=True)
+        self.process.start()
+        self.name = parent.recv()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _extype, _value, _traceback):
+        self.close()
+
+    def close(self):
+        """Kill the server"""
+        self.process.terminate()
+        self.process.join()
+
+
+def mock_connection(server):
+    """A requests session talking plain HTTP to the mock server, with
+    the make_api_call volapi's Connection offers"""
+    import requests
+
+    class MockConnection(requests.Session):
+        """Pretends to be volapi's Connection"""
+
+        def request(self, method, url, *args, **kw):
+            if url.startswith("https://"):
+                url = "http://" + url[8:]
+            return super().request(method, url, *args, **kw)
+
+        def make_api_call(self, call, params, heads=None, host=None):
+            """Make a REST API call"""
+            url = "http://{}/rest/{}".format(host or server, call)
+            return self.get(url, params=params, headers=heads or {}).json()
+
+    return MockConnection()
+
+
+class MockRoom:
+    """Stand-in for volapi's Room, uploading the way volapi does, but to
+    the mock server"""
+
+    class User:
+        """Nobody"""
+        nick = "bench"
+
+        def login(self, _password):
+            """Sure"""
+            pass
+
+    def __init__(self, server, name="bench"):
+        self.server = server
+        self.name = self.room_id = name
+        self.key = self.password = ""
+        self.user = self.User()
+        self.conn = mock_connection(server)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _extype, _value, _traceback):
+        self.conn.close()
+
+    def upload_file(self, filename, upload_as=None, blocksize=None, callback=None,
+                    information_callback=None, allow_timeout=False):
+        """Upload like volapi.Room.upload_file"""
+        from volapi.utils import delayed_close
+
+        _ = allow_timeout
+        with delayed_close(filename) as file:
+            return self._upload(file, upload_as, blocksize, callback,
+                                information_callback)
+
+    def _upload(self, file, upload_as, blocksize, callback, information_callback):
+        """The actual upload, with the file not closing under us"""
+        import requests
+        from volapi.multipart import Data
+
+        filename = upload_as or os.path.split(file.name)[1]
+        files = Data({"file": {"name": filename, "value": file}},
+                     blocksize=blocksize, callback=callback)
+        headers = {"Origin": "http://{}".format(self.server)}
+        headers.update(files.headers)
+        while True:
+            info = self.conn.make_api_call("getUploadKey", {"name": self.user.nick})
+            key, server, file_id = info["key"], info["server"], info["file_id"]
+            info = dict(key=key, server=server, file_id=file_id, room=self.room_id,
+                        filename=filename, len=files.len, resumecount=0)
+            if information_callback and information_callback(info) is False:
+                continue
+            break
+        params = {"room": self.room_id, "key": key, "filename": filename}
+        while True:
+            try:
+                self.conn.post("http://{}/upload".format(server),
+                               params=params, data=files,
+                               headers=headers).raise_for_status()
+                return file_id
+            except requests.exceptions.ConnectionError as ex:
+                if "aborted" not in repr(ex):
+                    raise
+                resume = self.conn.make_api_call("uploadStatus", {"key": key}, None, server)
+                resume = resume["receivedBytes"]
+                if resume <= 0:
+                    raise ConnectionError("Cannot resume") from ex
+                file.seek(resume)
+                files = Data({"file": {"name": filename, "value": file}},
+                             blocksize=blocksize, callback=callback,
+                             logical_offset=resume)
+                headers.update(files.headers)
+                params["startAt"] = resume
+                info["resumecount"] += 1
+                if information_callback:
+                    information_callback(info)
+
+
+def make_files(directory, count, size):
+    """Create count files of size bytes of incompressible data"""
+    seed = os.urandom(SEED_BLOCK)
+    files = []
+    for i in range(count):
+        name = os.path.join(directory, "file{:05}.bin".format(i))
+        with open(name, "wb") as filep:
+            remaining = size
+            while remaining:
+                written = filep.write(seed[:min(remaining, SEED_BLOCK)])
+                remaining -= written
+        files.append(name)
+    return files
+
+
+def run_startup(name, spec):
+    """Measure how long the command takes to get going, in fresh
+    interpreters: importing it, and starting it up to parsing arguments"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        p for p in (os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                    env.get("PYTHONPATH")) if p)
+    code = ("import time; start = time.perf_counter(); import volaupload.main; "
+            "print(time.perf_counter() - start)")
+    imports, startups = [], []
+    for _ in range(spec["runs"]):
+        out = subprocess.run([sys.executable, "-c", code], env=env, check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout
+        imports.append(float(out) * 1000)
+        wall = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "volaupload", "--version"], env=env,
+                       check=True, stdout=subprocess.DEVNULL)
+        startups.append((time.perf_counter() - wall) * 1000)
+    return dict(scenario=name, runs=spec["runs"],
+                import_ms=statistics.median(imports), import_min_ms=min(imports),
+                startup_ms=statistics.median(startups), startup_min_ms=min(startups))
+
+
+def run_scenario(name, spec, scale=1.0, extra=()):
+    """Run a scenario, returning its measurements"""
+    if "runs" in spec:
+        return run_startup(name, spec)
+    from .main import parse_args
+    from .main import upload_files
+    from .progress import Progress
+
+    count, size = spec["files"], max(1, int(spec["size"] * scale))
+    options = {k: spec[k] for k in ("latency", "bandwidth", "fail_after") if k in spec}
+    if "fail_after" in options:
+        options["fail_after"] = int(options["fail_after"] * scale)
+    cache = os.environ.get("XDG_CACHE_HOME")
+    with tempfile.TemporaryDirectory(prefix="volabench") as directory:
+        os.environ["XDG_CACHE_HOME"] = os.path.join(directory, "cache")
+        try:
+            files = make_files(directory, count, size)
+            argv = ["-r", "bench", "-u", "bench", "-j", str(spec.get("jobs", 1))]
+            argv += list(extra) + files
+            # Whatever is in ~/.vola.conf would make results incomparable
+            args = parse_args(argv, config_file=os.devnull)
+            with MockServer(**options) as server, MockRoom(server.name) as room:
+                progress = Progress(0, 0)
+                with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                    cpu, wall = time.process_time(), time.perf_counter()
+                    upload_files(room, args, progress)
+                    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+                stats = room.conn.make_api_call("stats", dict())
+        finally:
+            if cache is None:
+                os.environ.pop("XDG_CACHE_HOME", None)
+            else:
+                os.environ["XDG_CACHE_HOME"] = cache
+    total = count * size
+    return dict(scenario=name, files=count, file_size=size, bytes=total,
+                wall_secs=wall, cpu_secs=cpu,
+                throughput_mbs=total / wall / (1 << 20) if wall else 0.0,
+                cpu_secs_per_gb=cpu / (total / (1 << 30)) if total else 0.0,
+                per_file_ms=wall * 1000 / count,
+                per_file_cpu_ms=cpu * 1000 / count,
+                posts=stats["posts"], aborted=stats["aborted"],
+                wire_bytes=stats["bytes"], options=options)
+
+
+def main():
+    """Run benchmarks"""
+    parser = argparse.ArgumentParser(description="Benchmark volaupload against a mock server")
+    parser.add_argument("--scenario", "-s", dest="scenarios", action="append",
+                        choices=tuple(SCENARIOS.keys()),
+                        help="Scenario to run (default: all)")
+    parser.add_argument("--scale", dest="scale", type=float, default=1.0,
+                        help="Scale file sizes by this factor")
+    parser.add_argument("--output", "-o", dest="output", type=str, default=None,
+                        help="Write the JSON report here instead of stdout")
+    parser.add_argument("extra", nargs=argparse.REMAINDER,
+                        help="Extra volaupload options, after --")
+    args = parser.parse_args()
+    extra = [e for e in args.extra if e != "--"]
+
+    results = []
+    for name in args.scenarios or SCENARIOS:
+        print("Running {}...".format(name), file=sys.stderr, flush=True)
+        results.append(run_scenario(name, SCENARIOS[name], args.scale, extra))
+    report = dict(version=__version__,
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  argv=extra,
+                  results=results)
+    if args.output:
+        with open(args.output, "w") as outp:
+            json.dump(report, outp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+""" RealDolos' funky volafile upload tool (Checksums)"""
+
+# pylint: disable=broad-except
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+from importlib.util import find_spec
+
+HAS_XXHASH = find_spec("xxhash") is not None
+
+ALGORITHMS = ("sha256", "sha1", "md5", "sha512", "blake2b", "blake2s")
+if HAS_XXHASH:
+    ALGORITHMS += ("xxh64", "xxh3_64", "xxh128")
+
+# Guessing the algorithm of sha256sum and friends' output by digest length
+BY_LENGTH = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512"}
+
+# Bytes read at a time to hash what was not sent in one go
+CHUNK = 1 << 20
+
+
+def parse_algorithms(value):
+    """Comma separated list of digest algorithms"""
+    algorithms = []
+    for algorithm in str(value).lower().split(","):
+        algorithm = algorithm.strip().replace("-", "")
+        if not algorithm:
+            continue
+        if algorithm not in ALGORITHMS:
+            raise ValueError("Unsupported digest {} (supported: {})".format(
+                algorithm, ",".join(ALGORITHMS)))
+        if algorithm not in algorithms:
+            algorithms.append(algorithm)
+    if not algorithms:
+        raise ValueError("No digest given")
+    return algorithms
+
+
+def new_hash(algorithm):
+    """A fresh hash object"""
+    if algorithm.startswith("xxh"):
+        import xxhash
+
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+class Digesting:
+    """File-like wrapper of an upload source, hashing what is read from it
+    on the way out. Whatever is skipped by seeking ahead (e.g. when resuming
+    somewhere in the middle) is read once more and hashed right away, so
+    that the rest can still be hashed as it goes out."""
+
+    def __init__(self, source, algorithms, size, reopen):
+        self.source = source
+        self.hashes = {a: new_hash(a) for a in algorithms}
+        self.size = size
+        self.reopen = reopen
+        self.hashed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _extype, _value, _traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def update(self, data):
+        """Hash more data"""
+        for digest in self.hashes.values():
+            digest.update(data)
+        self.hashed += len(data)
+
+    def read(self, size=-1):
+        """Read, hashing what follows what was hashed so far"""
+        pos = self.source.tell()
+        data = self.source.read(size)
+        if pos <= self.hashed < pos + len(data):
+            self.update(memoryview(data)[self.hashed - pos:])
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Seek, hashing what is skipped when jumping ahead"""
+        if whence == os.SEEK_SET and offset > self.hashed:
+            self.catch_up(min(offset, self.size))
+        return self.source.seek(offset, whence)
+
+    def close(self):
+        """Close the source"""
+        self.source.close()
+
+    def catch_up(self, end):
+        """Hash what was not read up to end, reading it once more"""
+        if self.hashed >= end:
+            return
+        with self.reopen() as sourcep:
+            sourcep.seek(self.hashed)
+            while self.hashed < end:
+                data = sourcep.read(min(CHUNK, end - self.hashed))
+                if not data:
+                    break
+                self.update(data)
+
+    def hexdigests(self):
+        """Digests of the whole thing"""
+        self.catch_up(self.size)
+        return {a: d.hexdigest() for a, d in self.hashes.items()}
+
+
+def load_manifest(file):
+    """Expected digests by absolute path, from a manifest of ours or the
+    output of sha256sum and friends"""
+    expected = dict()
+    base = os.path.dirname(os.path.abspath(file))
+    with open(file, "r", encoding="utf-8", errors="surrogateescape") as manifestp:
+        for line in manifestp:
+            line = line.rstrip("\r\n")
+            if not line.strip():
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                path = entry.get("file")
+                if not path:
+                    continue
+                digests = {a: entry[a] for a in ALGORITHMS if entry.get(a)}
+                if entry.get("size") is not None:
+                    digests["size"] = entry["size"]
+            else:
+                digest, _, path = line.partition(" ")
+                path = path[1:] if path[:1] in (" ", "*") else path
+                algorithm = BY_LENGTH.get(len(digest))
+                if not algorithm or not path:
+                    continue
+                digests = {algorithm: digest.lower()}
+                # sha256sum paths are relative to where it ran, which most
+                # likely is where the files are
+                if not os.path.isabs(path) and not os.path.exists(path):
+                    path = os.path.join(base, path)
+            expected.setdefault(os.path.abspath(path), dict()).update(digests)
+    return expected
+
+
+class Manifest:
+    """Digests of what went up where, written as JSON lines as uploads
+    finish, and optionally checked against an earlier manifest"""
+
+    def __init__(self, algorithms, file=None, verify=None):
+        self.algorithms = list(algorithms)
+        self.file = file
+        self.verify = verify
+        self.expected = load_manifest(verify) if verify else dict()
+        for digests in self.expected.values():
+            for algorithm in digests:
+                if algorithm in ALGORITHMS and algorithm not in self.algorithms:
+                    self.algorithms.append(algorithm)
+        self.lock = threading.Lock()
+        self.entries = 0
+        self.verified = 0
+        self.mismatches = 0
+        self.fp = open(file, "w", encoding="utf-8") if file else None
+
+    def check(self, file, size, digests):
+        """Compare with the expected digests, returning whether they matched"""
+        expected = self.expected.get(os.path.abspath(file))
+        if expected is None:
+            print("\n{} is not in {}, cannot verify it".format(file, self.verify),
+                  file=sys.stderr, flush=True)
+            return None
+        wrong = ["{} is {}, expected {}".format(a, digests[a], e)
+                 for a, e in expected.items() if a in digests and digests[a] != e]
+        if expected.get("size", size) != size:
+            wrong.insert(0, "size is {}, expected {}".format(size, expected["size"]))
+        if wrong:
+            print("\nChecksum mismatch for {}: {}".format(file, "; ".join(wrong)),
+                  file=sys.stderr, flush=True)
+            return False
+        return True
+
+    def add(self, file, size, digests, room, server=None, file_id=None, name=None):
+        """Record an upload"""
+        archive = hasattr(file, "members")
+        entry = dict(file=file.name if archive else os.path.abspath(file),
+                     name=name or file.name, size=size, room=room, server=server or None,
+                     file_id=file_id, time=time.time())
+        entry.update(digests)
+        if self.verify and not archive:
+            entry["verified"] = self.check(file, size, digests)
+        with self.lock:
+            self.entries += 1
+            if entry.get("verified"):
+                self.verified += 1
+            elif entry.get("verified") is False:
+                self.mismatches += 1
+            if self.fp:
+                self.fp.write(json.dumps(entry) + "\n")
+                self.fp.flush()
+
+    def close(self):
+        """Done writing"""
+        with self.lock:
+            if self.fp:
+                self.fp.close()
+                self.fp = None
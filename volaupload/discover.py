@@ -0,0 +1,152 @@
+""" RealDolos' funky volafile upload tool (File discovery)"""
+
+# pylint: disable=broad-except
+
+import os
+import sys
+import threading
+
+from collections import deque
+from stat import S_ISDIR
+from stat import S_ISREG
+
+
+class FileRecord:
+    """A file found for uploading, with everything sorting, totals and
+    progress need, so nothing has to be stat'ed again"""
+
+    __slots__ = ("path", "parent", "name", "size", "mtime")
+
+    def __init__(self, path, size, mtime=0.0):
+        self.path = path
+        self.parent, self.name = os.path.split(path)
+        self.size = size
+        self.mtime = mtime
+
+    @classmethod
+    def stat(cls, path):
+        """Record for a file, stat'ing it"""
+        stat = os.stat(path)
+        return cls(str(path), stat.st_size, stat.st_mtime)
+
+    def __fspath__(self):
+        return self.path
+
+    def __str__(self):
+        return self.path
+
+    def __repr__(self):
+        return "<FileRecord({!r}, {})>".format(self.path, self.size)
+
+
+class Discovery:
+    """Finds the files to upload, walking directories in parallel with
+    os.scandir, and hands FileRecords to a sink as soon as they are found"""
+
+    def __init__(self, paths, recurse=False, workers=4):
+        self.paths = list(paths)
+        self.recurse = recurse
+        self.workers = max(1, workers)
+        self.cond = threading.Condition()
+        self.dirs = deque()
+        self.pending = 0
+        self.error = None
+
+    def top(self, sink):
+        """Handle paths given on the command line, in order"""
+        for i in map(str, self.paths):
+            if "*" in i or "?" in i and os.name == "nt":
+                # Windows is too stupid to glob
+                from path import Path
+
+                i = Path(i)
+                parent = i.parent or Path(".")
+                for file in parent.files(str(i.name)):
+                    sink(FileRecord.stat(file))
+                continue
+            try:
+                stat = os.stat(i)
+            except OSError:
+                continue
+            if S_ISREG(stat.st_mode):
+                sink(FileRecord(i, stat.st_size, stat.st_mtime))
+            elif self.recurse and S_ISDIR(stat.st_mode):
+                self.dirs.append(i)
+                self.pending += 1
+
+    def scan(self, directory, sink):
+        """Scan a single directory, returning its subdirectories"""
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if self.error:
+                        break
+                    try:
+                        if entry.is_dir():
+                            subdirs.append(entry.path)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            sink(FileRecord(entry.path, stat.st_size, stat.st_mtime))
+                    except OSError as ex:
+                        print("Cannot look at {}: {}".format(entry.path, ex),
+                              file=sys.stderr, flush=True)
+        except OSError as ex:
+            print("Cannot walk {}: {}".format(directory, ex), file=sys.stderr, flush=True)
+        return subdirs
+
+    def walker(self, sink):
+        """Scan directories until there are none left"""
+        while True:
+            with self.cond:
+                while not self.dirs and self.pending and not self.error:
+                    self.cond.wait()
+                if not self.dirs or self.error:
+                    return
+                directory = self.dirs.popleft()
+            try:
+                subdirs = self.scan(directory, sink)
+            except BaseException as ex:
+                with self.cond:
+                    self.error = self.error or ex
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                self.dirs.extend(subdirs)
+                self.pending += len(subdirs) - 1
+                self.cond.notify_all()
+
+    def run(self, sink):
+        """Call sink(record) for every file found, from several threads.
+        Blocks until everything was found; errors raised by the sink stop
+        the walk and are re-raised."""
+        self.top(sink)
+        # A single tree fans out into more directories soon enough, and idle
+        # walkers wait for them
+        threads = [threading.Thread(target=self.walker, args=(sink,),
+                                    name="walker-{}".format(i), daemon=True)
+                   for i in range(self.workers if self.pending else 0)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.25)
+        if self.error:
+            raise self.error
+
+    def done(self, file, uploaded=True):
+        """Called once a file went up, or failed for good"""
+        pass
+
+    def collect(self):
+        """All files found, as a list of FileRecords"""
+        files = []
+        lock = threading.Lock()
+
+        def sink(record):
+            """Collect a file"""
+            with lock:
+                files.append(record)
+
+        self.run(sink)
+        return files
@@ -0,0 +1,116 @@
+""" RealDolos' funky volafile upload tool (Upload index)"""
+
+# pylint: disable=broad-except
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_BLOCK_SIZE = 1 << 20
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        inode INTEGER NOT NULL,
+        digest TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS uploads (
+        digest TEXT NOT NULL,
+        room TEXT NOT NULL,
+        file_id TEXT,
+        name TEXT,
+        uploaded REAL NOT NULL,
+        PRIMARY KEY (digest, room)
+    )""",
+    )
+
+
+def hash_file(file, block_size=HASH_BLOCK_SIZE):
+    """Stream a file through the content hash"""
+    digest = hashlib.blake2b(digest_size=20)
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(file, "rb", buffering=0) as filep:
+        while True:
+            read = filep.readinto(buf)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+
+class Index:
+    """Index of content hashes of files and the rooms they went to"""
+
+    def __init__(self, file):
+        os.makedirs(os.path.dirname(str(file)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(file), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.lock, self.conn:
+            for stmt in SCHEMA:
+                self.conn.execute(stmt)
+        self.digests = dict()
+
+    def close(self):
+        """Close the index database"""
+        with self.lock:
+            self.conn.close()
+
+    def cached_digest(self, file, stat):
+        """Digest from the index, if the file did not change since"""
+        key = (stat.st_size, stat.st_mtime, stat.st_ino)
+        cached = self.digests.get(file)
+        if cached and cached[0] == key:
+            return cached[1]
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime, inode, digest FROM files WHERE path = ?",
+                (file,)).fetchone()
+        if row and tuple(row[:3]) == key:
+            self.digests[file] = key, row[3]
+            return row[3]
+        return None
+
+    def digest(self, file):
+        """Digest of a file, only reading it if it changed since last time"""
+        name = os.path.abspath(file)
+        stat = os.stat(name)
+        digest = self.cached_digest(name, stat)
+        if not digest:
+            digest = hash_file(name)
+            with self.lock, self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                    (name, stat.st_size, stat.st_mtime, stat.st_ino, digest))
+            self.digests[name] = (stat.st_size, stat.st_mtime, stat.st_ino), digest
+        return digest
+
+    def is_uploaded(self, digest, room):
+        """Was this content already uploaded to the room?"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM uploads WHERE digest = ? AND room = ?",
+                (digest, room)).fetchone() is not None
+
+    def filter_uploaded(self, files, room, workers=4):
+        """Return files not uploaded to the room yet, hashing in parallel"""
+        files = list(files)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            digests = list(pool.map(self.digest, files))
+        return [f for f, d in zip(files, digests) if not self.is_uploaded(d, room)]
+
+    def record(self, file, room, file_id=None):
+        """Record a successful upload of a file to a room"""
+        digest = self.digest(file)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)",
+                (digest, room, file_id, os.path.basename(str(file)), time.time()))
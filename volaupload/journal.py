@@ -0,0 +1,185 @@
+""" RealDolos' funky volafile upload tool (Resume journal)"""
+
+# pylint: disable=broad-except
+
+import json
+import os
+import sys
+import threading
+import time
+
+from .utils import lock_file
+from .utils import save_json
+
+# Files smaller than this are not journaled
+MIN_SIZE = 8 << 20
+
+
+class ResumeError(Exception):
+    """An upload cannot be resumed, and has to start over"""
+    pass
+
+
+def file_identity(file):
+    """Identity of a file: absolute path, size and mtime"""
+    stat = os.stat(file)
+    return os.path.abspath(file), stat.st_size, stat.st_mtime
+
+
+def entry_key(name, room):
+    """Journal key of uploads of a file to a room"""
+    return "{}:{}".format(room, name)
+
+
+class Journal:
+    """Persistent journal of uploads in flight, so that uploads can be
+    resumed after failures, even across runs. Files smaller than min_size
+    just start over, which is cheaper than journaling them.
+
+    Several processes may share a journal. Each one merges its own
+    entries into what is on disk, under a lock file."""
+
+    def __init__(self, file, interval=2.0, min_size=MIN_SIZE):
+        self.file = str(file)
+        self.interval = interval
+        self.min_size = min_size
+        self.lock = threading.RLock()
+        self.last = 0
+        self.dirty = False
+        # Entries this process looks after, and the ones it dropped
+        self.mine = dict()
+        self.gone = set()
+        self.entries = self.load()
+
+    def load(self):
+        """Entries on disk"""
+        try:
+            with open(self.file, "r") as journalp:
+                entries = json.load(journalp)
+            if not isinstance(entries, dict):
+                raise ValueError("Not a journal")
+            # Journals used to be keyed by path alone
+            return {entry_key(k, v["room"]) if os.path.isabs(k) else k: v
+                    for k, v in entries.items()}
+        except FileNotFoundError:
+            return dict()
+        except Exception as ex:
+            print("Ignoring broken journal {}: {}".format(self.file, ex),
+                  file=sys.stderr, flush=True)
+            return dict()
+
+    def lookup(self, file, room):
+        """Get the journal entry of a previous upload of an unchanged file to
+        the same room, or None"""
+        if getattr(file, "size", self.min_size) < self.min_size:
+            return None
+        name, size, mtime = file_identity(file)
+        key = entry_key(name, room)
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            if entry["size"] != size or entry["mtime"] != mtime:
+                self.discard(file, room)
+                return None
+            self.mine[key] = entry
+            return entry
+
+    def begin(self, file, room, info):
+        """Record a fresh upload key for a file, unless it is too small to
+        bother"""
+        name, size, mtime = file_identity(file)
+        if size < self.min_size:
+            return None
+        entry = dict(size=size, mtime=mtime, room=room,
+                     server=info.get("server"), key=info.get("key"),
+                     file_id=info.get("file_id"), filename=info.get("filename"),
+                     offset=0, resumes=0, updated=time.time())
+        key = entry_key(name, room)
+        with self.lock:
+            self.entries[key] = self.mine[key] = entry
+            self.gone.discard(key)
+            self.save(force=True)
+        return entry
+
+    def advance(self, entry, offset):
+        """Record the last offset handed to the server"""
+        entry["offset"] = offset
+        entry["updated"] = time.time()
+        self.dirty = True
+        self.save()
+
+    def discard(self, file, room):
+        """Forget about uploading a file to a room"""
+        key = entry_key(os.path.abspath(file), room)
+        with self.lock:
+            self.mine.pop(key, None)
+            if self.entries.pop(key, None) is not None:
+                self.gone.add(key)
+                self.save(force=True)
+
+    finish = discard
+
+    def save(self, force=False):
+        """Merge this process' entries into the journal on disk, at most
+        every interval seconds unless forced"""
+        now = time.time()
+        if not force and (not self.dirty or now - self.last < self.interval):
+            return
+        with self.lock:
+            self.last = now
+            self.dirty = False
+            if not self.mine and not self.gone:
+                return
+            try:
+                with lock_file(self.file):
+                    entries = self.load()
+                    for key in self.gone:
+                        entries.pop(key, None)
+                    entries.update(self.mine)
+                    save_json(self.file, entries)
+                self.gone.clear()
+                self.entries = entries
+            except Exception as ex:
+                print("Failed to write journal {}: {}".format(self.file, ex),
+                      file=sys.stderr, flush=True)
+
+
+def resume_upload(room, source, entry, block_size, callback, information):
+    """Continue a journaled upload where the server left off.
+    Raises ResumeError if the server does not know the upload (anymore)."""
+    from volapi.constants import BASE_URL
+    from volapi.multipart import Data
+
+    server, key = entry["server"], entry["key"]
+    try:
+        status = room.conn.make_api_call("uploadStatus", {"key": key, "c": 1},
+                                         None, server)
+        received = int(status["receivedBytes"])
+    except Exception as ex:
+        raise ResumeError("No status for {}: {}".format(key, ex))
+    if status.get("ended"):
+        raise ResumeError("Upload already ended")
+    if received <= 0 or received > entry["size"]:
+        raise ResumeError("Server has nothing to resume")
+
+    entry["resumes"] = entry.get("resumes", 0) + 1
+    information(dict(server=server, key=key, file_id=entry["file_id"],
+                     filename=entry["filename"], resumecount=entry["resumes"]))
+    source.seek(received)
+    files = Data({"file": {"name": entry["filename"], "value": source}},
+                 blocksize=block_size,
+                 callback=callback,
+                 logical_offset=received)
+    headers = {"Origin": BASE_URL}
+    headers.update(files.headers)
+    params = {"room": room.room_id, "key": key,
+              "filename": entry["filename"], "startAt": received}
+    if room.key:
+        params["roomKey"] = room.key
+    if room.password:
+        params["password"] = room.password
+    post = room.conn.post("https://{}/upload".format(server),
+                          params=params, data=files, headers=headers)
+    post.raise_for_status()
+    return entry["file_id"]
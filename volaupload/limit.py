@@ -0,0 +1,163 @@
+""" RealDolos' funky volafile upload tool (Rate limits)"""
+
+# pylint: disable=broad-except
+
+import threading
+import time
+
+from .utils import parse_size
+
+# Seconds of full rate that may go out at once after idling
+BURST = 0.5
+
+# Never hand out less than that many bytes at once
+MIN_BURST = 16 << 10
+
+# Seconds to sleep at most before looking at the rate again
+MAX_WAIT = 0.5
+
+UNLIMITED = ("0", "none", "off", "unlimited")
+
+
+def parse_rate(value):
+    """Bytes per second, or 0 for no limit"""
+    value = str(value).strip().lower()
+    if value in UNLIMITED:
+        return 0
+    return parse_size(value)
+
+
+def parse_clock(value):
+    """Minutes since midnight of HH[:MM]"""
+    hours, _, minutes = value.strip().partition(":")
+    hours, minutes = int(hours), int(minutes or 0)
+    if not 0 <= hours <= 24 or not 0 <= minutes < 60:
+        raise ValueError("Invalid time {}".format(value))
+    return hours * 60 + minutes
+
+
+class Schedule:
+    """Rates by time of day, e.g. 9-18=2M,18-9=0 (0 being no limit).
+    A rate without times applies whenever no range does."""
+
+    def __init__(self, spec):
+        self.spec = str(spec)
+        self.ranges = []
+        self.default = 0
+        for part in self.spec.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            times, sep, rate = part.rpartition("=")
+            if not sep:
+                self.default = parse_rate(rate)
+                continue
+            start, sep, end = times.partition("-")
+            if not sep:
+                raise ValueError("Invalid time range {}".format(times))
+            self.ranges.append((parse_clock(start), parse_clock(end), parse_rate(rate)))
+
+    def __str__(self):
+        return self.spec
+
+    def rate(self, now=None):
+        """Rate at a point in time, by default now"""
+        now = time.localtime(now)
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.ranges:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                # Range spanning midnight
+                return rate
+        return self.default
+
+
+class TokenBucket:
+    """Rate limiter shared by all uploads. Tokens (bytes) flow into the
+    bucket at the rate the schedule currently asks for, and whoever wants
+    to send has to take them out first."""
+
+    def __init__(self, schedule):
+        if not isinstance(schedule, Schedule):
+            schedule = Schedule(schedule)
+        self.schedule = schedule
+        self.cond = threading.Condition()
+        self.rate = schedule.rate()
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.checked = 0.0
+        self.waited = 0.0
+
+    @property
+    def burst(self):
+        """Bytes the bucket holds at most"""
+        return max(MIN_BURST, int(self.rate * BURST))
+
+    def set_rate(self, rate):
+        """Change the rate on the fly"""
+        with self.cond:
+            self.refill()
+            self.rate = rate
+            self.tokens = min(self.tokens, self.burst)
+            self.cond.notify_all()
+
+    def refill(self):
+        """Add what flowed in since the last time, following the schedule"""
+        now = time.monotonic()
+        if now - self.checked >= 1.0:
+            self.checked = now
+            rate = self.schedule.rate()
+            if rate != self.rate:
+                self.tokens += (now - self.last) * self.rate
+                self.last, self.rate = now, rate
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self, amount):
+        """Wait until amount bytes may go out"""
+        while amount > 0:
+            with self.cond:
+                self.refill()
+                if not self.rate:
+                    return
+                chunk = min(amount, self.burst)
+                start = time.monotonic()
+                while self.tokens < chunk:
+                    self.cond.wait(min(MAX_WAIT, (chunk - self.tokens) / self.rate))
+                    self.refill()
+                    if not self.rate:
+                        return
+                    chunk = min(chunk, self.burst)
+                self.tokens -= chunk
+                self.waited += time.monotonic() - start
+            amount -= chunk
+
+
+class Throttled:
+    """File-like wrapper of an upload source, paying for everything read
+    from it with tokens of a bucket"""
+
+    def __init__(self, source, bucket):
+        self.source = source
+        self.bucket = bucket
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _extype, _value, _traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def read(self, size=-1):
+        """Read, once there are tokens for it"""
+        data = self.source.read(size)
+        self.bucket.take(len(data))
+        return data
+
+    def close(self):
+        """Close the source"""
+        self.source.close()
@@ -0,0 +1,204 @@
+""" RealDolos' funky volafile upload tool (Source addresses)"""
+
+# pylint: disable=broad-except
+
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+from .retry import fatal
+from .retry import Stalled
+
+# Weight of new rate samples
+ALPHA = 0.3
+
+# Uploads smaller than this do not say much about a link's rate
+MIN_SAMPLE = 1 << 22
+
+# Consecutive network errors after which a link is taken out
+MAX_ERRORS = 2
+
+# Seconds a broken link is avoided at first, doubling each time it breaks
+# again, up to the cap
+COOLDOWN = 10.0
+COOLDOWN_CAP = 600.0
+
+POLICIES = ("rate", "rr")
+
+
+class Link:
+    """A source address, and how it fared"""
+
+    def __init__(self, address):
+        self.address = address
+        self.rate = None
+        self.active = 0
+        self.uploads = 0
+        self.bytes = 0
+        self.errors = 0
+        self.broken = 0
+        self.until = 0.0
+
+    def __str__(self):
+        return self.address
+
+    @property
+    def healthy(self):
+        """Not taken out right now"""
+        return self.until <= time.monotonic()
+
+
+class Links:
+    """Stripes uploads across several source addresses, round robin or
+    by their measured rates, leaving out links that keep breaking"""
+
+    def __init__(self, addresses, policy="rate"):
+        if isinstance(addresses, str):
+            addresses = addresses.split(",")
+        self.links = []
+        for address in addresses:
+            address = address.strip().strip("[]")
+            if address and all(l.address != address for l in self.links):
+                self.links.append(Link(address))
+        if not self.links:
+            raise ValueError("No source address given")
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy {}".format(policy))
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.next = 0
+
+    def __len__(self):
+        return len(self.links)
+
+    def current(self):
+        """Link of the upload in this thread, or the first healthy one"""
+        link = getattr(self.local, "link", None)
+        if link:
+            return link
+        with self.lock:
+            return next((l for l in self.links if l.healthy), self.links[0])
+
+    def pick(self):
+        """Link for the next upload"""
+        with self.lock:
+            links = [l for l in self.links if l.healthy]
+            if not links:
+                # Everything is broken; go with what comes back first
+                return min(self.links, key=lambda l: l.until)
+            if self.policy == "rr":
+                link = links[self.next % len(links)]
+                self.next += 1
+                return link
+            # Unmeasured links first, then the one promising the most per
+            # upload, counting the ones already running on it
+            return max(links, key=lambda l: (
+                l.rate is None, (l.rate or 0) / (l.active + 1), -l.active))
+
+    @contextmanager
+    def use(self):
+        """Bind connections of this thread to a link while uploading"""
+        link = self.pick()
+        with self.lock:
+            link.active += 1
+        previous, self.local.link = getattr(self.local, "link", None), link
+        try:
+            yield link
+        except Exception as ex:
+            self.failed(link, ex)
+            raise
+        finally:
+            self.local.link = previous
+            with self.lock:
+                link.active -= 1
+
+    def record(self, link, rate, size):
+        """Record the byte rate an upload over a link achieved"""
+        with self.lock:
+            link.uploads += 1
+            link.bytes += size
+            link.errors = link.broken = 0
+            if size < MIN_SAMPLE or rate <= 0:
+                return
+            link.rate = rate if link.rate is None else link.rate + ALPHA * (rate - link.rate)
+
+    def failed(self, link, ex):
+        """Account for a failed upload, taking the link out when the network
+        keeps failing on it"""
+        if fatal(ex) or not isinstance(ex, (OSError, Stalled)):
+            return
+        if getattr(getattr(ex, "response", None), "status_code", None):
+            # The server answered, so the link works
+            return
+        with self.lock:
+            link.errors += 1
+            if link.errors < MAX_ERRORS:
+                return
+            cooldown = min(COOLDOWN_CAP, COOLDOWN * (1 << min(link.broken, 16)))
+            link.broken += 1
+            link.errors = 0
+            link.until = time.monotonic() + cooldown
+        print("\nNot using {} for {:.0f}s: {}".format(link, cooldown, ex),
+              file=sys.stderr, flush=True)
+
+    def snapshot(self):
+        """Links, as plain data"""
+        with self.lock:
+            return {l.address: dict(rate=l.rate or 0.0, active=l.active, uploads=l.uploads,
+                                    bytes=l.bytes, healthy=l.healthy)
+                    for l in self.links}
+
+    def mount(self, conn):
+        """Keep connections of a requests session apart by link, so that a
+        pooled connection is only reused by uploads over the same link"""
+        import requests
+
+        links = self
+
+        class LinkAdapter(requests.adapters.HTTPAdapter):
+            """Pools connections by source address"""
+
+            def build_connection_pool_key_attributes(self, request, verify, cert=None):
+                host_params, pool_kwargs = super().build_connection_pool_key_attributes(
+                    request, verify, cert)
+                pool_kwargs["source_address"] = (links.current().address, 0)
+                return host_params, pool_kwargs
+
+        conn.mount("https://", LinkAdapter())
+        conn.mount("http://", LinkAdapter())
+
+
+def override_socket(links):
+    """ Bind all sockets to the link of the current upload """
+    import socket
+
+    class BoundSocket(socket.socket):
+        """
+        requests is kinda an asshole when it comes to using source_address.
+        Also volapi is also an asshole.
+        """
+
+        def __init__(self, *args, **kw):
+            super().__init__(*args, **kw)
+
+        def connect(self, address):
+            try:
+                self.bind((links.current().address, 0))
+            except Exception:
+                pass
+            return super().connect(address)
+
+        def connect_ex(self, address):
+            try:
+                self.bind((links.current().address, 0))
+            except Exception:
+                pass
+            return super().connect_ex(address)
+
+        def bind(self, address):
+            super().bind(address)
+
+    socket.socket = BoundSocket
@@ -6,39 +6,71 @@ import argparse
 import os
 import random
 import re
-import shutil
 import sys
-import time
+import threading
 
 from configparser import ConfigParser
+from contextlib import ExitStack
+from contextlib import nullcontext
 from functools import partial
 
-from path import Path
-
 from ._version import __version__
 
+from .digest import Digesting
+from .digest import Manifest
+from .digest import parse_algorithms
+from .discover import Discovery
+from .journal import Journal
+from .journal import resume_upload
+from .journal import ResumeError
+from .limit import Schedule
+from .limit import Throttled
+from .limit import TokenBucket
+from .links import Links
+from .links import override_socket
+from .links import POLICIES as BIND_POLICIES
+from .pack import Archive
+from .pack import FORMATS as PACK_FORMATS
+from .pack import HAS_ZSTD
+from .pack import pack
+from .progress import Progress
+from .progress import Renderer
+from .readahead import attach as attach_readahead
+from .readahead import default_strategy as default_readahead
+from .readahead import STRATEGIES as READAHEAD
+from .retry import backoff
+from .retry import retryable
+from .retry import set_timeout
+from .retry import StallWatchdog
+from .scheduler import Job
+from .scheduler import POLICIES
+from .scheduler import Policy
+from .scheduler import run_workers
+from .scheduler import Tags
+from .scheduler import WorkQueue
+from .servers import ServerRanking
+from .servers import SlowServer
+from .source import open_source
+from .source import SharedFile
 from .stat import FAC
 from .stat import Statistics
+from .timing import RunProfile
+from .timing import Timed
+from .tuning import BlockSizeTuner
+from .update import start_update_check
 
+from .utils import cache_dir
+from .utils import CONFIG
 from .utils import format_time
+from .utils import parse_size
 from .utils import POSIX_FADV_WILLNEED
 from .utils import progressbar
 from .utils import shorten
 from .utils import SORTING
-from .utils import try_advise
 from .utils import try_unlink
 
-try:
-    import colorama
-    HAS_COLORAMA = True
-except ImportError:
-    HAS_COLORAMA = False
-
-
-BUFFER_SIZE = 1 << 26
 BLOCK_SIZE = 1 << 20
-CONFIG = Path("~/.vola.conf").expand()
-UPDATE_INFO = "https://api.github.com/repos/RealDolos/volaupload/tags"
+COLORS = re.compile("\033\\[.*?m")
 
 
 def get_version():
@@ -51,37 +83,84 @@ def get_version():
 
 class Callback:
     """ Bundle and print process information """
-    def __init__(self, file, name, nums, info):
+    def __init__(self, file, name, item, progress, info):
         self.file = file
         self.name = name
-        self.nums = nums
+        self.item = item
+        self.progress = progress
         self.info = info
+        # Fan-out threads go by the worker they upload for
+        self.worker = threading.current_thread().name
+        self.room = None
         self.stat = Statistics()
+        self.cur = 0
+        self.tot = 0
+        self.readahead = None
+        self.journal = None
+        self.entry = None
+        self.abort = None
+        self.profile = None
+        self.hook = None
 
     def __call__(self, cur, tot):
-        """Print progress (and fadvise)"""
-        self.stat.record(cur)
-
-        cols = shutil.get_terminal_size((25, 72)).columns
+        """Record progress (and read ahead)"""
+        profile = self.profile
+        if profile:
+            profile.enter()
+        try:
+            if self.abort:
+                raise self.abort
+            self.cur, self.tot = cur, tot
+            self.stat.block()
+            if self.entry is not None:
+                self.journal.advance(self.entry, cur)
+
+            # Tell OS to buffer some moar!
+            if self.readahead:
+                self.readahead.advance(cur, self.stat.brate)
+            if self.hook:
+                self.hook(self)
+        finally:
+            if profile:
+                profile.leave("callback")
+
+    def snapshot(self):
+        """Machine readable state of this upload"""
+        snap = self.stat.snapshot(self.tot)
+        snap.update(file=self.name, item=self.item, worker=self.worker, room=self.room,
+                    server=self.info.get("server") or None,
+                    resumes=self.info.get("resumecount", 0))
+        return snap
+
+    def status(self, cols):
+        """Compose the status line, as regularly colored and stripped versions"""
+        progress = self.progress
+        cur, tot = self.cur, max(1, self.tot)
+        snap = self.stat.snapshot(tot)
 
         def colorstripped(line):
             """Return regularly colored and stripped versions of a print message"""
-            return line, re.sub("\033\[.*?m", "", line)
+            return line, COLORS.sub("", line)
 
         def baseinfo():
             """Compose basic information"""
             ccur, ctot, per = cur / FAC, tot / FAC, float(cur) / tot
             ptot = ""
-            lnum = len(str(self.nums["files"]))
-            if self.nums["files"] > 1:
+            files = progress.files
+            if progress.discovering:
+                files = "{}+".format(files)
+            lnum = len(str(files))
+            if progress.files > 1 or progress.discovering:
                 if cols > 100:
-                    ptot = progressbar(self.nums["cur"] + cur, self.nums["total"], 10) + " "
+                    ptot = progressbar(progress.current, max(1, progress.total), 10) + " "
                 else:
                     ptot = "{:3.0%}".format(
-                        min(0.999, float(self.nums["cur"] + cur) / self.nums["total"]))
-            times = "{}/{}".format(format_time(self.stat.runtime), format_time(self.stat.eta(tot)))
+                        min(0.999, float(progress.current) / max(1, progress.total)))
+                if progress.active > 1:
+                    ptot += "({}x) ".format(progress.active)
+            times = "{}/{}".format(format_time(snap["runtime"]), format_time(snap["eta"]))
             fmt = ("\033[1m{ptot}\033[0m"
-                   "\033[31;1m{num:{lnum}}/{files:{lnum}}\033[0m - "
+                   "\033[31;1m{num:{lnum}}/{files:>{lnum}}\033[0m - "
                    "\033[33;1m{progress}\033[0m "
                    "\033[1m{per:6.1%}\033[0m "
                    "{{}} {ccur:.1f}/{ctot:.1f} {server}{resumes} - "
@@ -91,71 +170,150 @@ class Callback:
             resumes = self.info.get("resumecount", 0)
             resumes = "" if not resumes else "/{}".format(resumes)
             return fmt.format(ptot=ptot,
-                              num=self.nums["item"], lnum=lnum,
-                              files=self.nums["files"],
+                              num=self.item, lnum=lnum,
+                              files=files,
                               progress=progressbar(cur, tot, 30 if cols > 100 else 5),
                               per=per,
                               ccur=ccur, ctot=ctot,
                               server=server, resumes=resumes,
-                              rate=self.stat.rate, lrate=self.stat.rate_last,
+                              rate=snap["rate"] / FAC, lrate=snap["rate_window"] / FAC,
                               times=times)
 
         line, stripped = colorstripped(baseinfo())
         short_file = shorten(self.name, max(5, cols - len(stripped) - 2))
-        line, stripped = colorstripped(line.format(short_file))
-
-        cols = max(0, cols - len(stripped) - 4)
-        tty = sys.stdout.isatty()
-        if not tty or (not HAS_COLORAMA and os.name == "nt"):
-            line = stripped
-
-        if tty:
-            clear = " " * cols if os.name == "nt" else "\033[K"
-            print("\r{}{}".format(line, clear),
-                  end="", flush=True)
-        else:
-            print(line, flush=True)
-
-        # Tell OS to buffer some moar!
-        if cur + BUFFER_SIZE < tot:
-            try_advise(self.file, cur + BUFFER_SIZE, BUFFER_SIZE * 2)
-
-
-def upload(room, file, nums, block_size=BLOCK_SIZE, force_server=None, prefix=None):
-    """Uploads a file and prints the progress while pushing bits and bytes"""
-    info = dict(server="")
+        return colorstripped(line.format(short_file))
+
+
+def upload(room, file, item, progress,
+           block_size=BLOCK_SIZE, force_server=None, prefix=None,
+           split_threshold=None, readers=4, mapped=False,
+           readahead="fadvise", drop_behind=False, journal=None, tuner=None,
+           ranking=None, source=None, limiter=None, links=None, manifest=None,
+           profiler=None, hook=None):
+    """Uploads a file and prints the progress while pushing bits and bytes.
+    source may be an already opened reader of the file, e.g. a shared one.
+    limiter is a TokenBucket shared by all uploads, links the source
+    addresses to stripe uploads across, manifest records digests of what
+    was sent, and profiler where the time went. hook is called with the
+    Callback of the upload for every block."""
+    if tuner:
+        block_size = tuner.choose(force_server)
+    upload_as = file.name
+    if prefix:
+        upload_as = "{} - {}".format(prefix.strip(), upload_as)
+    info = dict(server="", filename=upload_as)
+    rejections = 0
+    profile = profiler.begin(file, room.name) if profiler else None
 
     def information(idict):
         """Information callback"""
-        nonlocal info, force_server
+        nonlocal info, force_server, rejections
         info.update(idict)
         if force_server:
             return info.get("server", "") == force_server
+        if ranking and not idict.get("resumecount"):
+            accepted = ranking.accept(info.get("server", ""), rejections)
+            rejections += not accepted
+            return accepted
         return True
 
-    with open(file, "rb", buffering=block_size) as advp:
-        callback = Callback(advp, file.name, nums, info)
-        callback(0, file.size)
-        upload_as = file.name
-        if prefix:
-            upload_as = "{} - {}".format(prefix.strip(), upload_as)
-        room.upload_file(advp,
-                         upload_as=upload_as,
-                         blocksize=block_size,
-                         callback=callback,
-                         information_callback=information,
-                         allow_timeout=True)
-        print("", flush=True)
-
-
-def parse_args():
+    def journaled(idict):
+        """Information callback, recording fresh upload keys"""
+        accepted = information(idict)
+        if accepted and not idict.get("resumecount"):
+            callback.entry = journal.begin(file, room.name, info)
+        return accepted
+
+    if source is None:
+        source = open_source(file, block_size, split_threshold, readers, mapped,
+                             readahead == "prefetch", drop_behind)
+    else:
+        # Other uploads still need the pages
+        drop_behind = False
+    with source as advp, (links.use() if links else nullcontext()) as link:
+        callback = Callback(advp, file.name, item, progress, info)
+        callback.hook = hook
+        callback.room = room.name
+        callback.readahead = attach_readahead(advp, readahead, drop_behind)
+        reader = Timed(advp, profile) if profile else advp
+        if limiter:
+            reader = Throttled(reader, limiter)
+            reader = Timed(reader, profile, "throttle") if profile else reader
+        size = file.size
+        if manifest:
+            reopen = file.open if hasattr(file, "members") else partial(open, file, "rb")
+            reader = Digesting(reader, manifest.algorithms, size, reopen)
+            reader = Timed(reader, profile, "hash") if profile else reader
+        callback(0, size)
+        callback.profile = profile
+        progress.start(callback)
+        try:
+            entry = None
+            if journal:
+                callback.journal = journal
+                entry = journal.lookup(file, room.name)
+            file_id = None
+            if entry:
+                try:
+                    callback.entry = entry
+                    file_id = resume_upload(room, reader, entry, block_size, callback, information)
+                except ResumeError:
+                    journal.discard(file, room.name)
+                    callback.entry = entry = None
+                    advp.seek(0)
+            if not entry:
+                file_id = room.upload_file(reader,
+                                           upload_as=upload_as,
+                                           blocksize=block_size,
+                                           callback=callback,
+                                           information_callback=(journaled if journal
+                                                                 else information),
+                                           allow_timeout=True)
+        except SlowServer:
+            progress.abort(callback)
+            if profile:
+                profiler.end(profile, size, ok=False)
+            if journal:
+                # Do not resume on the same slow server
+                journal.discard(file, room.name)
+            raise
+        except BaseException:
+            progress.abort(callback)
+            if profile:
+                profiler.end(profile, size, ok=False)
+            raise
+        if profile:
+            profiler.end(profile, size)
+        if journal:
+            journal.finish(file, room.name)
+        progress.finish(callback, size)
+        if tuner:
+            tuner.record(info.get("server"), block_size, callback.stat.brate, size)
+        if ranking:
+            ranking.record(info.get("server"), callback.stat.brate, size)
+        if link:
+            links.record(link, callback.stat.brate, size)
+        if manifest:
+            manifest.add(file, size, reader.hexdigests(), room.name,
+                         info.get("server"), file_id, upload_as)
+    return file_id
+
+
+def block_size_type(value):
+    """Block sizes are either sizes or auto"""
+    if str(value).strip().lower() == "auto":
+        return "auto"
+    return parse_size(value)
+
+
+def parse_args(argv=None, config_file=CONFIG):
     """Parse command line arguments into something sane!"""
     sorts = tuple(SORTING.keys()) + ("none", "rnd")
 
     config = ConfigParser()
     aliases = dict()
     try:
-        config.read(CONFIG)
+        config.read(config_file)
         try:
             aliases = config["aliases"]
         except Exception:
@@ -170,42 +328,157 @@ def parse_args():
                 "~/.vola.conf with a [vola] section and set user= and passwd= "
                 " block_size accordingly")
         )
-    parser.add_argument('--room', '-r', dest='room', type=str, required=True,
-                        help='room or alias to upload to')
+    parser.add_argument('--room', '-r', dest='rooms', type=str, required=True,
+                        action="append",
+                        help='room or alias to upload to; give more than once (or '
+                        'separate by commas) to upload to several rooms at once')
     parser.add_argument('--user', '-u', dest='user', type=str,
                         default=config.get("user", None),
                         help='user name to use')
     parser.add_argument('--passwd', '-p', dest='passwd', type=str,
                         default=config.get("passwd", None),
                         help='password if you wanna greenfag')
-    parser.add_argument('--sort', '-s', dest='sort', type=str, default="name",
-                        help=('upload files in some order ({})'.
+    parser.add_argument('--sort', '-s', dest='sort', type=str,
+                        default=config.get("sort", None), choices=sorts,
+                        help=('upload files in some order ({}); without it, uploads '
+                              'start while files are still being found'.
                               format(','.join(sorts))))
+    parser.add_argument("--schedule", dest="schedule", type=str,
+                        default=config.get("schedule", "fifo"), choices=POLICIES,
+                        help="Upload files as they come (fifo), shortest or longest first, "
+                        "or by priority or deadline tags")
+    parser.add_argument("--tags", dest="tags", type=str,
+                        default=config.get("tags", None),
+                        help="JSON lines of files (or patterns) with a priority and/or "
+                        "deadline, e.g. {\"file\": \"*.txt\", \"priority\": 1}")
     parser.add_argument("--delete-after", dest="delete", action="store_true",
                         help="Delete files after successful upload")
-    parser.add_argument("--bs", "-b", dest="block_size", type=int,
-                        default=int(config.get("block_size", BLOCK_SIZE)),
-                        help="Use this block size")
+    parser.add_argument("--bs", "-b", dest="block_size", type=block_size_type,
+                        default=config.get("block_size", BLOCK_SIZE),
+                        help="Use this block size, or auto to tune it per server")
     parser.add_argument("--attempts", "-t", dest="attempts", type=int,
                         default=int(config.get("attempts", 25)),
                         help="Retry failed uploads this many times")
+    parser.add_argument("--jobs", "-j", dest="jobs", type=int,
+                        default=int(config.get("jobs", 1)),
+                        help="Upload this many files concurrently")
+    parser.add_argument("--split-threshold", dest="split_threshold", type=parse_size,
+                        default=config.get("split_threshold", None),
+                        help="Read files at least this large (e.g. 1G) using "
+                        "concurrent range readers")
+    parser.add_argument("--readers", dest="readers", type=int,
+                        default=int(config.get("readers", 4)),
+                        help="Number of concurrent range readers per large file")
+    parser.add_argument("--readahead", dest="readahead", type=str,
+                        default=config.get("readahead", default_readahead()),
+                        choices=tuple(READAHEAD.keys()),
+                        help="Read-ahead strategy")
+    parser.add_argument("--drop-behind", dest="drop_behind", action="store_true",
+                        help="Drop data already sent from the page cache")
+    parser.add_argument("--mmap", dest="mapped", action="store_true",
+                        help="Memory map files instead of reading them into buffers "
+                        "(files must not shrink while uploading)")
+    parser.add_argument("--no-mmap", dest="mapped", action="store_false",
+                        help="Read files regularly instead of memory mapping them")
+    parser.add_argument("--no-resume", dest="resume", action="store_false",
+                        help="Do not journal uploads for resuming them later")
+    parser.add_argument("--skip-uploaded", dest="skip_uploaded", action="store_true",
+                        help="Skip files whose contents were uploaded to the room before")
+    parser.add_argument("--hashers", dest="hashers", type=int,
+                        default=int(config.get("hashers", 4)),
+                        help="Number of files to hash concurrently for --skip-uploaded")
+    parser.add_argument("--manifest", dest="manifest", type=str,
+                        default=config.get("manifest", None),
+                        help="Write digests of uploaded files, computed while sending them, "
+                        "to this file")
+    parser.add_argument("--verify", dest="verify", type=str, default=None,
+                        help="Check digests against an earlier manifest, or the output of "
+                        "sha256sum and friends")
+    parser.add_argument("--digest", dest="digest", type=parse_algorithms,
+                        default=config.get("digest", "sha256"),
+                        help="Digest algorithms for the manifest, separated by commas")
     parser.add_argument("--prefix", dest="prefix", type=str, default=None,
                         help="Prefix file names")
     parser.add_argument("--bind", "-i", dest="bind", type=str,
                         default=config.get("bind", None),
-                        help="Bind to specific source address")
+                        help="Bind to specific source address, or stripe uploads across "
+                        "several (separated by commas)")
+    parser.add_argument("--bind-policy", dest="bind_policy", type=str,
+                        default=config.get("bind_policy", "rate"), choices=BIND_POLICIES,
+                        help="Stripe uploads across source addresses by their measured "
+                        "rates, or round robin (rr)")
     parser.add_argument("--retarddir", "-R", dest="rdir", action="store_true",
                         help="Upload all files within directories passed to "
                         "volaupload (this is mainly here for people too stupid to find and xargs!)")
+    parser.add_argument("--walkers", dest="walkers", type=int,
+                        default=int(config.get("walkers", 4)),
+                        help="Number of directories to walk concurrently")
+    parser.add_argument("--pack", dest="pack", type=str,
+                        default=config.get("pack", None), choices=PACK_FORMATS,
+                        help="Upload small files packed into archives of this format "
+                        "({})".format(",".join(PACK_FORMATS)))
+    parser.add_argument("--pack-size", dest="pack_size", type=parse_size,
+                        default=config.get("pack_size", "256M"),
+                        help="Pack small files into archives of about this size")
+    parser.add_argument("--pack-below", dest="pack_below", type=parse_size,
+                        default=config.get("pack_below", "1M"),
+                        help="Pack files smaller than this")
+    parser.add_argument("--watch", dest="watch", type=str, default=None,
+                        help="Keep running, uploading files as they are completed in "
+                        "this directory")
+    parser.add_argument("--settle", dest="settle", type=float,
+                        default=config.get("settle", 1.0),
+                        help="Seconds files in watched directories have to stay "
+                        "unchanged before they are uploaded")
+    parser.add_argument("--limit", dest="limit", type=Schedule,
+                        default=config.get("limit", None),
+                        help="Limit all uploads together to this many bytes per second "
+                        "(e.g. 2M), or by time of day (e.g. 9-18=2M,0)")
     parser.add_argument("--force-server", dest="force_server", type=str,
                         default=config.get("force_server", None),
                         help="Force a particular server")
+    parser.add_argument("--pick-server", dest="pick_server", action="store_true",
+                        help="Probe upload servers and steer uploads to the fastest ones")
+    parser.add_argument("--min-rate", dest="min_rate", type=parse_size,
+                        default=config.get("min_rate", None),
+                        help="Retry elsewhere when an upload stays slower than this "
+                        "many bytes per second (e.g. 1M)")
+    parser.add_argument("--stall-time", dest="stall_time", type=float,
+                        default=config.get("stall_time", 60.0),
+                        help="Abort and retry uploads stalling for this many seconds "
+                        "(0 to wait forever)")
+    parser.add_argument("--stall-rate", dest="stall_rate", type=parse_size,
+                        default=config.get("stall_rate", "4K"),
+                        help="Uploads slower than this many bytes per second are stalling")
+    parser.add_argument("--metrics", dest="metrics", type=str,
+                        default=config.get("metrics", None),
+                        help="Serve metrics over HTTP on [HOST:]PORT "
+                        "(/metrics for Prometheus, /metrics.json)")
+    parser.add_argument("--metrics-file", dest="metrics_file", type=str,
+                        default=config.get("metrics_file", None),
+                        help="Append metrics as JSON lines to this file")
+    parser.add_argument("--metrics-interval", dest="metrics_interval", type=float,
+                        default=config.get("metrics_interval", 10.0),
+                        help="Seconds between lines in the metrics file")
+    parser.add_argument("--profile", dest="profile", type=str, default=None,
+                        help="Write where the time went, per file and in total, as JSON "
+                        "to this file (- for stderr)")
+    parser.add_argument("--cprofile", dest="cprofile", type=str, default=None,
+                        help="Write cProfile statistics of the uploads to this file")
     parser.add_argument("--version", "-V", action="version", version=get_version(),
                         help=argparse.SUPPRESS)
-    parser.set_defaults(delete=False, rdir=False)
-    parser.add_argument('files', metavar='FILE', type=str, nargs='+',
+    parser.set_defaults(delete=False, rdir=False,
+                        pick_server=config.get("pick_server", "no").lower() in (
+                            "yes", "true", "1", "on"),
+                        drop_behind=config.get("drop_behind", "no").lower() in (
+                            "yes", "true", "1", "on"),
+                        mapped=config.get("mmap", "no").lower() in ("yes", "true", "1", "on"),
+                        skip_uploaded=config.get("skip_uploaded", "no").lower() in (
+                            "yes", "true", "1", "on"),
+                        resume=config.get("resume", "yes").lower() in ("yes", "true", "1", "on"))
+    parser.add_argument('files', metavar='FILE', type=str, nargs='*',
                         help='files to upload')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if not args.user or not re.match(r"[\w\d]{3,12}$", args.user):
         parser.error("No valid user name provided")
@@ -213,24 +486,89 @@ def parse_args():
     if args.passwd and args.passwd == "":
         parser.error("No valid user password provided")
 
-    args.room = aliases.get(args.room, args.room)
-    if not args.room:
+    if args.jobs < 1:
+        parser.error("Need at least one job")
+
+    rooms = []
+    for room in ",".join(args.rooms).split(","):
+        for room in aliases.get(room.strip(), room.strip()).split(","):
+            room = room.strip()
+            if room and room not in rooms:
+                rooms.append(room)
+    if not rooms:
         parser.error("No valid room provided")
+    args.rooms, args.room = rooms, rooms[0]
+
+    if args.watch and args.files:
+        parser.error("Either watch a directory or upload files")
+    if not args.watch and not args.files:
+        parser.error("No files selected")
+    if any(os.path.basename(f) == "Thumbs.db" for f in args.files):
+        parser.error("No Thumbs.db for you!")
+    if args.files and not any(
+            os.path.isfile(f) or (args.rdir and os.path.isdir(f)) or
+            (os.name == "nt" and ("*" in f or "?" in f)) for f in args.files):
+        # Anything deeper is only found while uploading
+        parser.error("No valid files selected")
+    if args.watch and not os.path.isdir(args.watch):
+        parser.error("Cannot watch {}, not a directory".format(args.watch))
+    if args.pack and args.watch:
+        parser.error("Cannot pack files while watching a directory")
+    if args.pack == "tar.zst" and not HAS_ZSTD:
+        parser.error("Packing tar.zst needs the zstandard module")
+
+    if args.tags:
+        try:
+            args.tags = Tags(args.tags)
+        except Exception as ex:
+            parser.error("Cannot read tags: {}".format(ex))
+
+    args.links = None
+    if args.bind:
+        try:
+            args.links = Links(args.bind, args.bind_policy)
+        except ValueError as ex:
+            parser.error(str(ex))
+
+    args.index = None
+    if args.skip_uploaded:
+        from .index import Index
+
+        args.index = Index(os.path.join(cache_dir(), "index.sqlite"))
+
+    if args.watch:
+        from .watch import Watcher
+
+        state = os.path.join(cache_dir(), "watch-{}.json".format("+".join(args.rooms)))
+        args.files = Watcher(args.watch, state, recurse=args.rdir, workers=args.walkers,
+                             settle=args.settle)
+        return args
+
+    discovery = Discovery(args.files, recurse=args.rdir, workers=args.walkers)
+
+    if args.pack and not args.sort:
+        # Packing needs all files, and files of a directory next to each other
+        args.sort = "path"
 
-    def files_because_windows_is_stupid(files):
-        """Windows is too stupid to glob"""
-        for i in files:
-            i = Path(i)
-            if "*" in i or "?" in i and os.name == "nt":
-                parent = i.parent or Path(".")
-                yield from parent.files(str(i.name))
-                continue
-            if i.isfile():
-                yield i
-            elif args.rdir and i.isdir():
-                yield from i.walkfiles()
-
-    args.files = list(files_because_windows_is_stupid(args.files))
+    if not args.sort:
+        # Stream files to the uploaders while still looking for more
+        args.files = discovery
+        return args
+
+    args.files = discovery.collect()
+
+    if args.index and args.files:
+        count = len(args.files)
+        remaining = set()
+        for room in args.rooms:
+            remaining.update(args.index.filter_uploaded(args.files, room, args.hashers))
+        args.files = [f for f in args.files if f in remaining]
+        if len(args.files) != count:
+            print("Skipping {} already uploaded files".format(count - len(args.files)),
+                  flush=True)
+        if not args.files:
+            print("Nothing left to upload", flush=True)
+            sys.exit(0)
 
     if not len(args.files):
         parser.error("No valid files selected")
@@ -242,140 +580,359 @@ def parse_args():
     elif args.sort:
         args.files = sorted(args.files, key=SORTING[args.sort])
 
-    return args
+    if args.pack:
+        args.files = pack(args.files, args.pack, args.pack_below, args.pack_size)
 
+    return args
 
-def check_update():
-    """Check if there is a new version"""
-    import requests
 
-    config = ConfigParser()
-    try:
-        config.read(CONFIG)
+class Feeder(threading.Thread):
+    """Feeds files found by a discovery into the work queue"""
+
+    def __init__(self, discovery, queue, progress, copies=1):
+        super().__init__(name="feeder", daemon=True)
+        self.discovery = discovery
+        self.queue = queue
+        self.progress = progress
+        self.copies = copies
+        self.lock = threading.Lock()
+        self.error = None
+
+    def sink(self, file):
+        """Queue a file as soon as it was found"""
+        if file.name == "Thumbs.db":
+            raise NotGonnaDoIt("No Thumbs.db for you!")
+        with self.lock:
+            progress = self.progress
+            progress.files += 1
+            progress.total += file.size * self.copies
+            job = Job(file, progress.files)
+        self.queue.put(job)
+
+    def run(self):
+        self.progress.discovering = True
         try:
-            section = config["update"]
-        except Exception:
-            config.add_section("update")
-            section = config["update"]
-    except Exception:
-        section = dict()
-
-    check = float(section.get("check", 0))
-    ver = section.get("version", __version__)
-    url = section.get("url", None)
-    now = time.time()
-
-    if check + 86400 < now:
-        ver = requests.get(UPDATE_INFO).json()[0]
-        url = ver["zipball_url"]
-        ver = ver["name"]
-        section["check"] = str(now)
-        section["version"] = ver
-        section["url"] = url
-        with open(CONFIG, "w") as configfile:
-            config.write(configfile)
-
-    if ([int(i) for i in ver.replace("v", "").split(".")] >
-            [int(i) for i in __version__.split(".")] and url):
-        print("New version {} available:\nInstall: pip3 install -U {}".
-              format(ver, url),
-              flush=True)
-
-def override_socket(bind):
-    """ Bind all sockets to specific address """
-    import socket
-
-    class BoundSocket(socket.socket):
-        """
-        requests is kinda an asshole when it comes to using source_address.
-        Also volapi is also an asshole.
-        """
-
-        def __init__(self, *args, **kw):
-            super().__init__(*args, **kw)
-
-        def connect(self, address):
-            try:
-                self.bind((bind, 0))
-            except Exception:
-                pass
-            return super().connect(address)
+            self.discovery.run(self.sink)
+        except BaseException as ex:
+            # A closed queue means the workers gave up already
+            if not self.queue.closed:
+                self.error = ex
+                # Rather upload nothing more than just some of the files
+                self.queue.drop()
+        finally:
+            self.progress.discovering = False
+            self.queue.close()
+
+    def start(self):
+        super().start()
+        return self
+
+    def join(self, timeout=None):
+        """Wait for discovery to finish, raising what went wrong"""
+        super().join(timeout)
+        if self.error:
+            raise self.error
+
+
+class NotGonnaDoIt(Exception):
+    """roboCop, pls"""
+    pass
+
+
+def upload_files(room, args, progress):
+    """Upload all files selected by args to an open room, or a list of
+    open rooms"""
+
+    rooms = list(room) if isinstance(room, (list, tuple)) else [room]
+    files = args.files
+    streaming = isinstance(files, Discovery)
+    if not streaming:
+        if any(m.name == "Thumbs.db"
+               for f in files for m in getattr(f, "members", (f,))):
+            raise NotGonnaDoIt("No Thumbs.db for you!")
+        progress.files = len(files)
+        progress.total = sum(f.size for f in files) * len(rooms)
+
+    renderer = journal = tuner = ranking = feeder = metrics = limiter = manifest = None
+    profiler = None
+    try:
+        if args.metrics or args.metrics_file:
+            from .metrics import Metrics
+
+            metrics = Metrics(progress, args.metrics, args.metrics_file,
+                              args.metrics_interval).start()
+        if args.pick_server or args.min_rate:
+            ranking = ServerRanking(os.path.join(cache_dir(), "servers.json"),
+                                    min_rate=args.min_rate)
+            progress.watchers.append(ranking.watch)
+        if args.links:
+            for each in rooms:
+                args.links.mount(each.conn)
+            if metrics:
+                metrics.links = args.links
+        if args.stall_time > 0:
+            progress.watchers.append(StallWatchdog(args.stall_rate, args.stall_time).watch)
+            for each in rooms:
+                set_timeout(each.conn, args.stall_time)
+        if args.profile or args.cprofile:
+            profiler = RunProfile(args.profile, args.cprofile)
+        if args.manifest or args.verify:
+            manifest = Manifest(args.digest, args.manifest, args.verify)
+        if args.limit:
+            limiter = TokenBucket(args.limit)
+            if metrics:
+                metrics.limiter = limiter
+        renderer = Renderer(progress).start()
+        if args.resume:
+            journal = Journal(os.path.join(cache_dir(), "journal.json"))
+        block_size = args.block_size
+        if block_size == "auto":
+            block_size = BLOCK_SIZE
+            tuner = BlockSizeTuner(os.path.join(cache_dir(), "blocksizes.json"),
+                                   block_size)
+
+        if streaming:
+            print("Pushing attack bytes to mainframe...", flush=True)
+        else:
+            print("Pushing attack bytes to mainframe... {:.2f}MB in total".
+                  format(progress.total / FAC),
+                  flush=True)
+        upload_file = partial(upload,
+                              progress=progress,
+                              block_size=block_size,
+                              force_server=args.force_server,
+                              prefix=args.prefix,
+                              split_threshold=args.split_threshold,
+                              readers=args.readers,
+                              mapped=args.mapped,
+                              readahead=args.readahead,
+                              drop_behind=args.drop_behind,
+                              journal=journal,
+                              tuner=tuner,
+                              ranking=ranking if args.pick_server else None,
+                              limiter=limiter,
+                              links=args.links,
+                              manifest=manifest,
+                              profiler=profiler)
+
+        def push(job, targets):
+            """Upload a file to the target rooms at the same time, reading it
+            only once. Returns file ids and errors by room."""
+            results, errors = dict(), dict()
+            if isinstance(job.file, Archive):
+                return push_archive(job, targets)
+            if len(targets) == 1:
+                try:
+                    results[targets[0]] = upload_file(room=targets[0], file=job.file,
+                                                      item=job.item)
+                except Exception as ex:
+                    errors[targets[0]] = ex
+                return results, errors
+
+            def push_one(target, source):
+                """Upload to one of the rooms"""
+                try:
+                    results[target] = upload_file(room=target, file=job.file,
+                                                  item=job.item, source=source)
+                except Exception as ex:
+                    errors[target] = ex
 
-        def connect_ex(self, address):
             try:
-                self.bind((bind, 0))
-            except Exception:
-                pass
-            return super().connect_ex(address)
-
-        def bind(self, address):
-            super().bind(address)
+                shared = SharedFile(job.file, block_size)
+            except Exception as ex:
+                for target in targets:
+                    errors[target] = ex
+                return results, errors
+            threads = [threading.Thread(target=push_one, args=(target, shared.open()),
+                                        name=threading.current_thread().name, daemon=True)
+                       for target in targets]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.25)
+            return results, errors
+
+        def push_archive(job, targets):
+            """Upload an archive to the target rooms at the same time, each
+            streaming it on its own"""
+            results, errors = dict(), dict()
+            estimate = job.file.size
+            sources = []
+            try:
+                for _ in targets:
+                    sources.append(job.file.open())
+            except Exception as ex:
+                # Compressed archives read all members upfront
+                for source in sources:
+                    source.close()
+                for target in targets:
+                    errors[target] = ex
+                return results, errors
+            if job.file.size != estimate:
+                # Compressed now, so the actual size is known
+                with progress.lock:
+                    progress.total += (job.file.size - estimate) * len(targets)
+
+            def push_one(target, source):
+                """Upload to one of the rooms"""
+                try:
+                    results[target] = upload_file(room=target, file=job.file,
+                                                  item=job.item, source=source,
+                                                  journal=None)
+                except Exception as ex:
+                    errors[target] = ex
+
+            if len(targets) == 1:
+                push_one(targets[0], sources[0])
+                return results, errors
+            threads = [threading.Thread(target=push_one, args=(target, source),
+                                        name=threading.current_thread().name, daemon=True)
+                       for target, source in zip(targets, sources)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.25)
+            return results, errors
+
+        def work(job):
+            """Upload a single file to all rooms, retrying as often as requested"""
+            targets = job.rooms or rooms
+            archive = isinstance(job.file, Archive)
+            results, errors = dict(), dict()
+            if args.index and not archive:
+                try:
+                    digest = args.index.digest(job.file)
+                except Exception as ex:
+                    # As good as failing to upload it
+                    errors = {target: ex for target in targets}
+                else:
+                    todo = [t for t in targets if not args.index.is_uploaded(digest, t.name)]
+                    if len(todo) != len(targets):
+                        with progress.lock:
+                            progress.skipped += len(targets) - len(todo)
+                            progress.total -= job.file.size * (len(targets) - len(todo))
+                        if not todo:
+                            if streaming:
+                                files.done(job.file)
+                            return
+                    targets = todo
+            if not errors:
+                results, errors = push(job, targets)
+            if args.index:
+                for target, file_id in results.items():
+                    for member in getattr(job.file, "members", (job.file,)):
+                        args.index.record(member, target.name, file_id)
+            if errors:
+                job.attempt += 1
+                final = job.attempt >= args.attempts or not any(
+                    retryable(ex) for ex in errors.values())
+                for target, ex in errors.items():
+                    print("\nFailed to upload {}{}: {} (attempt: {}{})".
+                          format(job.file,
+                                 " to {}".format(target.name) if len(rooms) > 1 else "",
+                                 ex, job.attempt, ", giving up" if final else ""),
+                          file=sys.stderr, flush=True)
+                if metrics:
+                    metrics.retry(final=final)
+                if profiler and not final:
+                    profiler.retry()
+                if not final:
+                    # Go to the back of the line, so that one sick file does
+                    # not hold up everything else
+                    job.rooms = [t for t in targets if t in errors]
+                    queue.requeue(job, backoff(job.attempt - 1))
+                    return
+                if archive:
+                    job.file.discard()
+                elif streaming:
+                    files.done(job.file, uploaded=False)
+                return
+            if archive:
+                job.file.discard()
+            if args.delete:
+                for member in getattr(job.file, "members", (job.file,)):
+                    try_unlink(member)
+            if streaming:
+                files.done(job.file)
+
+        policy = Policy(args.schedule, args.tags)
+        if streaming:
+            # Ordering needs everything found so far in the queue
+            fifo = args.schedule == "fifo" and not args.tags
+            queue = WorkQueue(maxsize=max(64, args.jobs * 4) if fifo else 0, policy=policy)
+            feeder = Feeder(files, queue, progress, len(rooms)).start()
+        else:
+            queue = WorkQueue((Job(file, i + 1) for i, file in enumerate(files)),
+                              policy=policy)
+            queue.close()
+        if metrics:
+            metrics.queue = queue
+        run_workers(queue, args.jobs, profiler.wrap(work) if profiler else work)
+        if feeder:
+            feeder.join()
+            if progress.skipped:
+                print("Skipped {} already uploaded files".format(progress.skipped),
+                      flush=True)
+            if not progress.files:
+                raise ValueError("No valid files selected")
+        if manifest and manifest.verify:
+            print("Verified {} uploads against {}".format(manifest.verified, manifest.verify),
+                  flush=True)
+            if manifest.mismatches:
+                raise ValueError("{} uploads did not match {}".format(
+                    manifest.mismatches, manifest.verify))
+    finally:
+        if renderer:
+            renderer.stop()
+        if metrics:
+            metrics.stop()
+        if journal:
+            journal.save(force=True)
+        if tuner:
+            tuner.save()
+        if ranking:
+            ranking.save()
+        if manifest:
+            manifest.close()
+        if profiler:
+            profiler.write()
 
-    socket.socket = BoundSocket
 
 def main():
     """Program, kok"""
 
     args = parse_args()
 
-    if args.bind:
-        override_socket(args.bind)
+    if args.links:
+        override_socket(args.links)
 
+    update = None
     try:
-        check_update()
+        update = start_update_check()
     except Exception as ex:
         print("Failed to check for new version:", ex,
               file=sys.stderr, flush=True)
 
     from volapi import Room
 
-    stat = Statistics()
-    total_current = 0
+    progress = Progress(0, 0)
     try:
         print("Starting DoS... ", end="", flush=True)
 
-        with Room(args.room, args.user, subscribe=False) as room:
+        with ExitStack() as stack:
+            rooms = [stack.enter_context(Room(name, args.user, subscribe=False))
+                     for name in args.rooms]
             print("done")
             if args.passwd:
                 print("Greenfagging in as {}... ".format(args.user),
                       end="", flush=True)
-                room.user.login(args.passwd)
+                for room in rooms:
+                    room.user.login(args.passwd)
                 print("done")
 
-            files = args.files
-            if any(f.name == "Thumbs.db" for f in files):
-                class NotGonnaDoIt(Exception):
-                    """roboCop, pls"""
-                    pass
-                raise NotGonnaDoIt("No Thumbs.db for you!")
-            total_length = sum(f.size for f in files)
-
-            print("Pushing attack bytes to mainframe... {:.2f}MB in total".
-                  format(total_length / FAC),
-                  flush=True)
-            upload_file = partial(upload,
-                                  room=room,
-                                  block_size=args.block_size,
-                                  force_server=args.force_server,
-                                  prefix=args.prefix)
-            for i, file in enumerate(files):
-                for attempt in range(args.attempts):
-                    try:
-                        nums = dict(item=i + 1, files=len(files),
-                                    cur=total_current, total=total_length)
-                        upload_file(file=file, nums=nums)
-                        total_current += file.size
-                        stat.record(total_current)
-                        if args.delete:
-                            try_unlink(file)
-
-                        # Exit attempt loop
-                        break
-                    except Exception as ex:
-                        print("\nFailed to upload {}: {} (attempt: {})".
-                              format(file, ex, attempt),
-                              file=sys.stderr, flush=True)
-                        time.sleep(attempt * 0.1)
+            upload_files(rooms, args, progress)
     except Exception as ex:
         print("\nFailure to fly: {} ({})".format(ex, type(ex)), file=sys.stderr, flush=True)
         return 1
@@ -383,6 +940,8 @@ def main():
         print("\nUser canceled", file=sys.stderr, flush=True)
         return 3
     finally:
+        if update:
+            update.report()
         print("All done in {:.2f}secs ({:.2f}MB/s)".
-              format(stat.runtime, stat.rate))
+              format(progress.stat.runtime, progress.stat.rate))
     return 0
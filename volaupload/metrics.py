@@ -0,0 +1,232 @@
+""" RealDolos' funky volafile upload tool (Metrics)"""
+
+# pylint: disable=broad-except
+
+import json
+import sys
+import threading
+import time
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+# Upper bounds of the per-file upload duration histogram, in seconds
+BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def parse_address(address, host="127.0.0.1"):
+    """Parse [HOST:]PORT"""
+    address = str(address)
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        host = host.strip("[]") or "0.0.0.0"
+    else:
+        port = address
+    return host, int(port)
+
+
+def escape(value):
+    """Escape a Prometheus label value"""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves metrics in Prometheus' text format, or as JSON"""
+
+    def log_message(self, *args):
+        """Shut up"""
+        pass
+
+    def do_GET(self):
+        """/metrics and /metrics.json"""
+        metrics = self.server.metrics
+        try:
+            if self.path.startswith("/metrics.json"):
+                body, ctype = json.dumps(metrics.snapshot()), "application/json"
+            elif self.path.startswith("/metrics") or self.path == "/":
+                body, ctype = metrics.prometheus(), "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+        except Exception as ex:
+            self.send_error(500, str(ex))
+            return
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Metrics:
+    """Collects metrics of a batch of uploads, for a local HTTP endpoint
+    and/or a JSON-lines file written periodically"""
+
+    def __init__(self, progress, address=None, file=None, interval=10.0):
+        self.progress = progress
+        self.address = address
+        self.file = file
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.queue = None
+        self.limiter = None
+        self.links = None
+        self.retries = 0
+        self.failed = 0
+        self.resumes = 0
+        self.servers = dict()
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.durations = 0.0
+        self.server = None
+        self.stopped = threading.Event()
+        self.thread = None
+        progress.metrics = self
+
+    def finished(self, callback, size):
+        """Account for a completed upload"""
+        duration = callback.stat.runtime
+        server = callback.info.get("server") or "unknown"
+        with self.lock:
+            self.resumes += callback.info.get("resumecount", 0) or 0
+            entry = self.servers.setdefault(server, dict(uploads=0, bytes=0, seconds=0.0))
+            entry["uploads"] += 1
+            entry["bytes"] += size
+            entry["seconds"] += duration
+            self.buckets[bisect_left(BUCKETS, duration)] += 1
+            self.durations += duration
+
+    def retry(self, final=False):
+        """Account for a failed attempt, and files that failed for good"""
+        with self.lock:
+            self.retries += 1
+            self.failed += bool(final)
+
+    def snapshot(self):
+        """Everything we know, as plain data"""
+        snap = self.progress.snapshot()
+        with self.lock:
+            servers = {k: dict(v, rate=v["bytes"] / v["seconds"] if v["seconds"] else 0.0)
+                       for k, v in self.servers.items()}
+            cumulative, histogram = 0, dict()
+            for bound, count in zip(BUCKETS + ("+Inf",), self.buckets):
+                cumulative += count
+                histogram[str(bound)] = cumulative
+            snap.update(time=time.time(),
+                        retries=self.retries,
+                        failed=self.failed,
+                        resumes=self.resumes + sum(u["resumes"] for u in snap["uploads"]),
+                        queue=len(self.queue) if self.queue is not None else 0,
+                        limit=self.limiter.rate if self.limiter else 0,
+                        throttled=self.limiter.waited if self.limiter else 0.0,
+                        servers=servers,
+                        links=self.links.snapshot() if self.links else dict(),
+                        durations=dict(buckets=histogram, sum=self.durations,
+                                       count=cumulative))
+        return snap
+
+    def prometheus(self):
+        """Metrics in Prometheus' text exposition format"""
+        snap = self.snapshot()
+        lines = []
+
+        def metric(name, kind, helptext, samples):
+            """Add a metric with its samples"""
+            lines.append("# HELP volaupload_{} {}".format(name, helptext))
+            lines.append("# TYPE volaupload_{} {}".format(name, kind))
+            for labels, value in samples:
+                labels = ",".join('{}="{}"'.format(k, escape(v)) for k, v in labels)
+                lines.append("volaupload_{}{} {}".format(
+                    name, "{{{}}}".format(labels) if labels else "", value))
+
+        metric("bytes_sent_total", "counter", "Bytes of completed uploads",
+               [((), snap["done"])])
+        metric("bytes_pushed", "gauge", "Bytes pushed so far, including uploads in flight",
+               [((), snap["pos"])])
+        metric("bytes_expected", "gauge", "Bytes to push in total", [((), snap["total"])])
+        metric("rate_bytes", "gauge", "Current byte rate over the sliding window",
+               [((), snap["rate_window"])])
+        metric("rate_average_bytes", "gauge", "Average byte rate so far", [((), snap["rate"])])
+        metric("eta_seconds", "gauge", "Estimated seconds left", [((), snap["eta"])])
+        metric("files_expected", "gauge", "Files found to upload", [((), snap["files"])])
+        metric("files_total", "counter", "Files done, by outcome",
+               [((("state", "finished"),), snap["finished"]),
+                ((("state", "skipped"),), snap["skipped"]),
+                ((("state", "failed"),), snap["failed"])])
+        metric("retries_total", "counter", "Failed upload attempts", [((), snap["retries"])])
+        metric("resumes_total", "counter", "Uploads resumed after connection losses",
+               [((), snap["resumes"])])
+        metric("queue_depth", "gauge", "Files waiting for a worker", [((), snap["queue"])])
+        metric("limit_bytes", "gauge", "Current rate limit (0 for none)", [((), snap["limit"])])
+        metric("throttled_seconds_total", "counter", "Seconds uploads waited for the rate limit",
+               [((), snap["throttled"])])
+        metric("uploads_inflight", "gauge", "Uploads in flight", [((), len(snap["uploads"]))])
+        # Uploads in flight go by the worker running them and their room,
+        # as labeling them by file would make new series for every file;
+        # files are in the JSON
+        uploads = [((("worker", u["worker"]), ("room", u["room"])), u)
+                   for u in snap["uploads"]]
+        metric("upload_rate_bytes", "gauge", "Byte rate of uploads in flight",
+               [(labels, u["rate_window"]) for labels, u in uploads])
+        metric("upload_idle_seconds", "gauge", "Seconds since uploads in flight sent a block",
+               [(labels, u["idle"]) for labels, u in uploads])
+        metric("upload_block_latency_seconds", "gauge",
+               "Block latency percentiles of uploads in flight",
+               [(labels + (("quantile", int(p[1:]) / 100),), value)
+                for labels, u in uploads for p, value in sorted(u["latency"].items())])
+        metric("server_rate_bytes", "gauge", "Average byte rate of completed uploads per server",
+               [((("server", k),), v["rate"]) for k, v in sorted(snap["servers"].items())])
+        metric("server_uploads_total", "counter", "Completed uploads per server",
+               [((("server", k),), v["uploads"]) for k, v in sorted(snap["servers"].items())])
+        metric("link_rate_bytes", "gauge", "Average byte rate of uploads per source address",
+               [((("link", k),), v["rate"]) for k, v in sorted(snap["links"].items())])
+        metric("link_healthy", "gauge", "Whether source addresses are used",
+               [((("link", k),), int(v["healthy"])) for k, v in sorted(snap["links"].items())])
+        durations = snap["durations"]
+        lines.append("# HELP volaupload_upload_seconds Seconds it took to upload files")
+        lines.append("# TYPE volaupload_upload_seconds histogram")
+        for bound, count in durations["buckets"].items():
+            lines.append('volaupload_upload_seconds_bucket{{le="{}"}} {}'.format(bound, count))
+        lines.append("volaupload_upload_seconds_sum {}".format(durations["sum"]))
+        lines.append("volaupload_upload_seconds_count {}".format(durations["count"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Append a snapshot to the metrics file"""
+        try:
+            with open(self.file, "a") as metricsp:
+                metricsp.write(json.dumps(self.snapshot()) + "\n")
+        except Exception as ex:
+            print("Failed to write metrics to {}: {}".format(self.file, ex),
+                  file=sys.stderr, flush=True)
+
+    def run(self):
+        """Timer loop writing the metrics file"""
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def start(self):
+        """Start serving and/or writing metrics"""
+        if self.address:
+            self.server = ThreadingHTTPServer(parse_address(self.address), MetricsHandler)
+            self.server.daemon_threads = True
+            self.server.metrics = self
+            threading.Thread(target=self.server.serve_forever, name="metrics-http",
+                             daemon=True).start()
+        if self.file:
+            self.thread = threading.Thread(target=self.run, name="metrics", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving, writing a final snapshot"""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+            self.write()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,209 @@
+""" RealDolos' funky volafile upload tool (Archive packing)"""
+
+# pylint: disable=broad-except
+
+import io
+import os
+import tarfile
+
+from bisect import bisect_right
+from importlib.util import find_spec
+
+from .utils import Reader
+
+# Compression modules are imported only when building archives
+HAS_ZSTD = find_spec("zstandard") is not None
+
+FORMATS = ("tar", "tar.gz", "tar.zst", "zip")
+
+# Bytes of the archive read at a time when compressing
+CHUNK = 1 << 20
+
+
+def tar_header(arcname, record):
+    """Tar header (including any pax extended header) of a file"""
+    info = tarfile.TarInfo(arcname)
+    info.size = record.size
+    info.mtime = int(record.mtime)
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+class TarStream(Reader):
+    """File-like, seekable, uncompressed tar archive of files, generated on
+    the fly while reading. The size is known upfront, and nothing but the
+    layout is kept in memory."""
+
+    def __init__(self, name, members, base):
+        self.name = name
+        self.members = members
+        self.base = base
+        self.starts = []
+        self.headers = []
+        offset = 0
+        for record in members:
+            self.starts.append(offset)
+            header = len(tar_header(self.arcname(record), record))
+            self.headers.append(header)
+            offset += header + -(-record.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        # Two zero blocks, padded to a full record, like tarfile does it
+        offset += 2 * tarfile.BLOCKSIZE
+        self.size = -(-offset // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+        self.end = offset
+        self.pos = 0
+        self.current = None
+        self.fp = None
+        self.closed = False
+
+    def arcname(self, record):
+        """Name of a file within the archive"""
+        return os.path.relpath(record.path, self.base).replace(os.sep, "/")
+
+    def member(self, idx):
+        """Open a member file for reading"""
+        if self.current != idx:
+            if self.fp:
+                self.fp.close()
+            self.fp = open(self.members[idx].path, "rb")
+            self.current = idx
+        return self.fp
+
+    def read(self, size=-1):
+        """Read up to size bytes, from at most one header or member"""
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if size is None or size < 0:
+            size = self.size
+        if self.pos >= self.size or not size:
+            return b""
+        idx = bisect_right(self.starts, self.pos) - 1
+        if idx < 0 or self.pos >= self.end - 2 * tarfile.BLOCKSIZE:
+            # Trailer
+            data = bytes(min(size, self.size - self.pos))
+        else:
+            record, offset = self.members[idx], self.pos - self.starts[idx]
+            header = self.headers[idx]
+            if offset < header:
+                data = tar_header(self.arcname(record), record)[offset:offset + size]
+            elif offset < header + record.size:
+                fp = self.member(idx)
+                fp.seek(offset - header)
+                data = fp.read(min(size, header + record.size - offset))
+                if not data:
+                    # Shrunk under us; keep the layout anyway
+                    data = bytes(min(size, header + record.size - offset))
+            else:
+                padded = -(-record.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                data = bytes(min(size, header + padded - offset))
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        """Close the member being read"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+
+class Archive:
+    """A bunch of small files, to be uploaded as a single archive"""
+
+    def __init__(self, name, members, fmt="tar"):
+        if fmt not in FORMATS:
+            raise ValueError("Unsupported archive format {}".format(fmt))
+        if fmt == "tar.zst" and not HAS_ZSTD:
+            raise ValueError("Packing tar.zst needs the zstandard module")
+        self.name = "{}.{}".format(name, fmt)
+        self.path = self.name
+        self.members = members
+        self.format = fmt
+        self.base = os.path.commonpath([os.path.dirname(os.path.abspath(m.path))
+                                        for m in members])
+        self.data = None
+        if fmt == "tar":
+            self.size = TarStream(self.name, members, self.base).size
+        else:
+            # Unknown until compressed
+            self.size = sum(m.size for m in members)
+
+    def __str__(self):
+        return "{} ({} files)".format(self.name, len(self.members))
+
+    def __repr__(self):
+        return "<Archive({!r}, {} files)>".format(self.name, len(self.members))
+
+    def build(self):
+        """Compress the archive into memory"""
+        buf = io.BytesIO()
+        if self.format == "zip":
+            import zipfile
+
+            with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as archive:
+                for record in self.members:
+                    archive.write(record.path, os.path.relpath(record.path, self.base))
+        else:
+            if self.format == "tar.gz":
+                import gzip
+
+                compressor = gzip.GzipFile(filename="", mode="wb", fileobj=buf, mtime=0)
+            else:
+                import zstandard
+
+                compressor = zstandard.ZstdCompressor().stream_writer(buf, closefd=False)
+            with TarStream(self.name, self.members, self.base) as tar, compressor:
+                while True:
+                    data = tar.read(CHUNK)
+                    if not data:
+                        break
+                    compressor.write(data)
+        return buf.getvalue()
+
+    def open(self):
+        """A reader of the archive for an upload"""
+        if self.format == "tar":
+            return TarStream(self.name, self.members, self.base)
+        if self.data is None:
+            self.data = self.build()
+            self.size = len(self.data)
+        reader = io.BytesIO(self.data)
+        reader.name = self.name
+        reader.size = self.size
+        return reader
+
+    def discard(self):
+        """Done uploading; forget the compressed data"""
+        self.data = None
+
+
+def pack(files, fmt, below, target):
+    """Replace files smaller than below by archives of about target bytes,
+    named after the directory they are in, keeping the order of everything
+    else"""
+    result, batch, batch_size, count = [], [], 0, 0
+
+    def flush():
+        """Turn the current batch into an archive"""
+        nonlocal batch, batch_size, count
+        if len(batch) == 1:
+            result.append(batch[0])
+        elif batch:
+            count += 1
+            base = os.path.commonpath([os.path.dirname(os.path.abspath(m.path))
+                                       for m in batch])
+            name = "{}-{:04}".format(os.path.basename(base) or "pack", count)
+            result.append(Archive(name, batch, fmt))
+        batch, batch_size = [], 0
+
+    for file in files:
+        if file.size >= below:
+            result.append(file)
+            continue
+        if batch and batch_size + file.size > target:
+            flush()
+        batch.append(file)
+        batch_size += file.size
+    flush()
+    return result
@@ -0,0 +1,195 @@
+""" RealDolos' funky volafile upload tool (Progress)"""
+
+# pylint: disable=broad-except
+
+import os
+import shutil
+import signal
+import sys
+import threading
+
+from .stat import Statistics
+
+# Only Windows needs colorama to color the terminal
+HAS_COLORAMA = False
+if os.name == "nt":
+    try:
+        import colorama
+        HAS_COLORAMA = True
+    except ImportError:
+        pass
+
+
+class Progress:
+    """Shared progress of all uploads of a batch"""
+
+    def __init__(self, files, total):
+        self.files = files
+        self.total = total
+        self.done = 0
+        self.finished = 0
+        self.inflight = []
+        self.lock = threading.RLock()
+        self.stat = Statistics()
+        self.renderer = None
+        self.metrics = None
+        self.watchers = []
+        self.discovering = False
+        self.skipped = 0
+
+    @property
+    def current(self):
+        """Bytes pushed so far, including uploads still in flight"""
+        return self.done + sum(cb.cur for cb in list(self.inflight))
+
+    @property
+    def active(self):
+        """Number of uploads currently in flight"""
+        return len(self.inflight)
+
+    @property
+    def focus(self):
+        """The upload to show, which is the oldest one in flight"""
+        try:
+            return self.inflight[0]
+        except IndexError:
+            return None
+
+    def start(self, callback):
+        """Register an upload in flight"""
+        with self.lock:
+            self.inflight.append(callback)
+
+    def finish(self, callback, size):
+        """Mark an upload as completed, and keep its final line around"""
+        with self.lock:
+            self.abort(callback)
+            self.done += size
+            self.finished += 1
+            self.stat.record(self.current)
+            callback.cur = callback.tot = max(callback.tot, size)
+            callback.stat.record(callback.cur)
+            if self.metrics:
+                self.metrics.finished(callback, size)
+            if self.renderer:
+                self.renderer.render(callback, final=True)
+
+    def snapshot(self):
+        """Machine readable state of the batch and all uploads in flight"""
+        with self.lock:
+            inflight = list(self.inflight)
+            snap = self.stat.snapshot(self.total)
+            snap.update(pos=self.current, done=self.done, files=self.files,
+                        finished=self.finished,
+                        skipped=self.skipped, discovering=self.discovering)
+        snap["uploads"] = [cb.snapshot() for cb in inflight]
+        return snap
+
+    def abort(self, callback):
+        """Forget about an upload that failed"""
+        with self.lock:
+            try:
+                self.inflight.remove(callback)
+            except ValueError:
+                pass
+
+
+class Ticker:
+    """Samples the progress of uploads in flight and runs the watchers at a
+    fixed rate from a timer thread, without showing anything"""
+
+    def __init__(self, progress, rate=10):
+        self.progress = progress
+        self.interval = 1.0 / rate
+        self.stopped = threading.Event()
+        self.thread = None
+        progress.renderer = self
+
+    def start(self):
+        """Start the timer thread"""
+        self.thread = threading.Thread(target=self.run, name="renderer", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the timer thread"""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, _extype, _value, _traceback):
+        self.stop()
+
+    def run(self):
+        """Timer loop"""
+        while not self.stopped.wait(self.interval):
+            try:
+                self.progress.stat.record(self.progress.current)
+                for callback in list(self.progress.inflight):
+                    callback.stat.record(callback.cur)
+                    for watcher in self.progress.watchers:
+                        watcher(callback)
+                self.render()
+            except Exception as ex:
+                print("Failed to render progress:", ex, file=sys.stderr, flush=True)
+
+    def render(self, callback=None, final=False):
+        """Show nothing"""
+        pass
+
+
+class Renderer(Ticker):
+    """Renders the progress of the upload in focus at a limited rate from
+    a timer thread, so that uploading never waits for the terminal"""
+
+    def __init__(self, progress, rate=10, stream=None):
+        super().__init__(progress, rate)
+        self.stream = stream or sys.stdout
+        self.tty = self.stream.isatty()
+        self.strip = not self.tty or (not HAS_COLORAMA and os.name == "nt")
+        self.lock = threading.Lock()
+        self.prev_winch = None
+        self.cols = 0
+        self.refresh()
+
+    def refresh(self, *_):
+        """Measure the terminal width again"""
+        self.cols = shutil.get_terminal_size((25, 72)).columns
+
+    def start(self):
+        """Start the timer thread, and watch for terminal resizes"""
+        if hasattr(signal, "SIGWINCH"):
+            try:
+                self.prev_winch = signal.signal(signal.SIGWINCH, self.refresh)
+            except ValueError:
+                # Not the main thread
+                pass
+        return super().start()
+
+    def stop(self):
+        """Stop rendering"""
+        super().stop()
+        if self.prev_winch is not None:
+            signal.signal(signal.SIGWINCH, self.prev_winch)
+            self.prev_winch = None
+
+    def render(self, callback=None, final=False):
+        """Print the status line of callback, or the upload in focus"""
+        callback = callback or self.progress.focus
+        if not callback:
+            return
+        with self.lock:
+            line, stripped = callback.status(self.cols)
+            if self.strip:
+                line = stripped
+            if self.tty:
+                clear = " " * max(0, self.cols - len(stripped) - 4) \
+                    if os.name == "nt" else "\033[K"
+                print("\r{}{}".format(line, clear),
+                      end="\n" if final else "", file=self.stream, flush=True)
+            else:
+                print(line, file=self.stream, flush=True)
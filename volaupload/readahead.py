@@ -0,0 +1,216 @@
+""" RealDolos' funky volafile upload tool (Read-ahead)"""
+
+# pylint: disable=broad-except
+
+import mmap
+import os
+import threading
+
+from collections import deque
+
+from .utils import POSIX_FADV_DONTNEED
+from .utils import POSIX_FADV_WILLNEED
+from .utils import Reader
+from .utils import try_advise
+
+WINDOW_MIN = 1 << 23
+WINDOW_MAX = 1 << 28
+
+# Seconds worth of data to keep ahead of the sender
+HORIZON = 4.0
+
+# Keep this much already sent data around, in case the server makes us
+# resume a bit earlier than where we are
+DROP_MARGIN = 1 << 24
+DROP_CHUNK = 1 << 24
+
+PAGE_SIZE = mmap.PAGESIZE
+
+
+def window_for(rate):
+    """Size of the read-ahead window for a byte rate"""
+    return int(min(WINDOW_MAX, max(WINDOW_MIN, rate * HORIZON)))
+
+
+class ReadAhead:
+    """Read-ahead for a single file. This one does not read ahead at all,
+    but optionally drops pages already sent from the page cache, so that
+    huge uploads do not evict everything else."""
+
+    def __init__(self, source, drop=False):
+        self.source = source
+        self.drop = drop
+        self.dropped = 0
+        self.size = 0
+        try:
+            self.size = os.fstat(source.fileno()).st_size
+        except Exception:
+            self.drop = False
+
+    def advance(self, pos, rate):
+        """The sender reached pos, sending at rate bytes/s"""
+        if self.drop and pos - DROP_MARGIN - self.dropped >= DROP_CHUNK:
+            end = (pos - DROP_MARGIN) // PAGE_SIZE * PAGE_SIZE
+            self.drop_range(self.dropped, end - self.dropped)
+            self.dropped = end
+
+    def drop_range(self, offset, length):
+        """Tell the OS we do not need a range anymore"""
+        mapping = getattr(self.source, "map", None)
+        if mapping is not None and hasattr(mapping, "madvise"):
+            try:
+                mapping.madvise(mmap.MADV_DONTNEED, offset, length)
+            except Exception:
+                pass
+        try_advise(self.source, offset, length, POSIX_FADV_DONTNEED)
+
+    def close(self):
+        """Done reading"""
+        pass
+
+
+class FadviseReadAhead(ReadAhead):
+    """Ask the OS to read windows ahead of the sender into the page cache"""
+
+    def __init__(self, source, drop=False):
+        super().__init__(source, drop)
+        self.advised = 0
+
+    def advance(self, pos, rate):
+        window = window_for(rate)
+        if pos + window // 2 >= self.advised and self.advised < self.size:
+            start = max(pos, self.advised)
+            try_advise(self.source, start, pos + window - start, POSIX_FADV_WILLNEED)
+            self.advised = pos + window
+        super().advance(pos, rate)
+
+
+class PrefetchReader(ReadAhead, Reader):
+    """File-like reader served by a background thread that reads ahead
+    into a bounded ring of buffers. Works where fadvise does not, and
+    keeps slow disks and network file systems from stalling the sender."""
+
+    def __init__(self, file, block_size, drop=False):
+        self.name = str(file)
+        self.fp = open(self.name, "rb", buffering=0)
+        super().__init__(self, drop)
+        self.block_size = max(block_size, 1 << 16)
+        self.depth = max(2, WINDOW_MIN // self.block_size)
+        self.cond = threading.Condition()
+        self.ring = deque()
+        self.pos = 0
+        self.next = 0
+        self.current = None
+        self.generation = 0
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="prefetch", daemon=True)
+        self.thread.start()
+
+    def fileno(self):
+        """File descriptor of the underlying file"""
+        return self.fp.fileno()
+
+    def _pread(self, fp, length, offset):
+        """Positional read on the prefetcher's own handle"""
+        if hasattr(os, "pread"):
+            return os.pread(fp.fileno(), length, offset)
+        fp.seek(offset)
+        return fp.read(length)
+
+    def run(self):
+        """Prefetch loop"""
+        try:
+            with open(self.name, "rb", buffering=0) as fp:
+                while True:
+                    with self.cond:
+                        while not self.closed and (
+                                len(self.ring) >= self.depth or self.next >= self.size):
+                            self.cond.wait()
+                        if self.closed:
+                            return
+                        offset, generation = self.next, self.generation
+                    data = self._pread(fp, self.block_size, offset)
+                    with self.cond:
+                        if generation == self.generation:
+                            self.ring.append((offset, data))
+                            self.next = offset + len(data) if data else self.size
+                            self.cond.notify_all()
+        except Exception as ex:
+            with self.cond:
+                self.error = ex
+                self.cond.notify_all()
+
+    def _seek(self, offset):
+        """Move, restarting the prefetcher if needed"""
+        with self.cond:
+            if offset != self.pos:
+                self.current = None
+                self.ring.clear()
+                self.next = offset
+                self.generation += 1
+                self.cond.notify_all()
+            self.pos = offset
+
+    def read(self, size=-1):
+        """Read up to size bytes from at most one prefetched buffer"""
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self.pos >= self.size:
+            return b""
+        if size is None or size < 0:
+            size = self.block_size
+        while True:
+            if self.current and self.current[0] <= self.pos < self.current[0] + len(
+                    self.current[1]):
+                offset, data = self.current
+                start = self.pos - offset
+                chunk = data[start:start + size] if start or size < len(data) else data
+                self.pos += len(chunk)
+                return chunk
+            with self.cond:
+                while not self.ring:
+                    if self.error:
+                        raise self.error
+                    self.cond.wait()
+                self.current = self.ring.popleft()
+                self.cond.notify_all()
+                if not self.current[1]:
+                    # Truncated under us
+                    return b""
+
+    def advance(self, pos, rate):
+        self.depth = max(2, window_for(rate) // self.block_size)
+        super().advance(pos, rate)
+
+    def close(self):
+        """Stop prefetching and close the file"""
+        if self.closed:
+            return
+        with self.cond:
+            self.closed = True
+            self.ring.clear()
+            self.cond.notify_all()
+        self.thread.join()
+        self.fp.close()
+
+
+STRATEGIES = dict(none=ReadAhead,
+                  fadvise=FadviseReadAhead,
+                  prefetch=PrefetchReader)
+
+
+def default_strategy():
+    """fadvise where the OS supports it, prefetching otherwise"""
+    return "fadvise" if POSIX_FADV_WILLNEED else "prefetch"
+
+
+def attach(source, strategy, drop=False):
+    """Read-ahead engine for an opened source"""
+    if isinstance(source, ReadAhead):
+        return source
+    if strategy == "fadvise":
+        return FadviseReadAhead(source, drop)
+    # Prefetching sources are opened as such, anything else reads ahead
+    # on its own or not at all
+    return ReadAhead(source, drop)
@@ -0,0 +1,88 @@
+""" RealDolos' funky volafile upload tool (Retries)"""
+
+# pylint: disable=broad-except
+
+import random
+import time
+
+from weakref import WeakKeyDictionary
+
+# Seconds to wait before the first retry
+BACKOFF_BASE = 0.5
+
+# Never wait longer than that many seconds between retries
+BACKOFF_CAP = 60.0
+
+# Errors retrying will not fix
+FATAL = (FileNotFoundError, IsADirectoryError, NotADirectoryError, PermissionError)
+
+# volapi refusing a file above the size limit of the room
+TOO_LARGE = "File must be at most"
+
+
+class Stalled(Exception):
+    """Upload stopped making (enough) progress"""
+    pass
+
+
+def fatal(ex):
+    """Is this error here to stay? Anything else, including garbage where
+    the server should have answered with JSON, might go away."""
+    if isinstance(ex, FATAL):
+        return True
+    return isinstance(ex, ValueError) and str(ex).startswith(TOO_LARGE)
+
+
+def retryable(ex):
+    """Is it worth trying again after this error?"""
+    if fatal(ex):
+        return False
+    status = getattr(getattr(ex, "response", None), "status_code", None)
+    if status:
+        # Client errors stay errors, unless the server just wants us to
+        # slow down a bit
+        return status >= 500 or status in (408, 429)
+    return True
+
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Seconds to wait before the next attempt: capped exponential
+    backoff with full jitter, so that workers do not retry in lockstep"""
+    return random.uniform(0, min(cap, base * (1 << min(attempt, 32))))
+
+
+def set_timeout(conn, timeout):
+    """Make a requests session give up on requests that hang for longer
+    than timeout seconds, unless told otherwise"""
+    request = conn.request
+
+    def timed(method, url, *args, **kw):
+        """Request, with a default timeout"""
+        if not args:
+            kw.setdefault("timeout", timeout)
+        return request(method, url, *args, **kw)
+
+    conn.request = timed
+
+
+class StallWatchdog:
+    """Progress watcher aborting uploads whose rate stays below a floor"""
+
+    def __init__(self, floor, period):
+        self.floor = floor
+        self.period = period
+        self.slow = WeakKeyDictionary()
+
+    def watch(self, callback):
+        """Check an upload in flight"""
+        if callback.abort or callback.cur >= callback.tot:
+            return
+        stat = callback.stat
+        if stat.runtime < self.period or stat.wrate >= self.floor:
+            self.slow.pop(callback, None)
+            return
+        now = time.monotonic()
+        since = self.slow.setdefault(callback, now)
+        if now - since >= self.period:
+            callback.abort = Stalled("Stalled at {:.1f}KB/s for {:.1f}s".format(
+                stat.wrate / 1024, now - since))
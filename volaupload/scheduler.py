@@ -0,0 +1,250 @@
+""" RealDolos' funky volafile upload tool (Scheduling)"""
+
+# pylint: disable=broad-except
+
+import json
+import os
+import threading
+import time
+
+from calendar import timegm
+from datetime import datetime
+from fnmatch import fnmatch
+from heapq import heappop
+from heapq import heappush
+from itertools import count
+
+POLICIES = ("fifo", "shortest", "longest", "priority", "deadline")
+
+INF = float("inf")
+
+
+def parse_deadline(value):
+    """Seconds since the epoch of a deadline: a number of them already, an
+    ISO date and time, or HH:MM (the next time it is that late)"""
+    if value is None or value == "":
+        return INF
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    if len(value) <= 5 and ":" in value:
+        hours, minutes = (int(v) for v in value.split(":", 1))
+        now = time.localtime()
+        deadline = time.mktime(now[:3] + (hours, minutes, 0) + now[6:8] + (-1,))
+        return deadline if deadline >= time.time() else deadline + 86400
+    deadline = datetime.fromisoformat(value)
+    if deadline.tzinfo:
+        return timegm(deadline.utctimetuple())
+    return time.mktime(deadline.timetuple())
+
+
+class Tags:
+    """Priorities and deadlines of files, from JSON lines such as
+    {"file": "some/file.mkv", "priority": 10, "deadline": "18:00"}, where
+    file may be a glob pattern, too. Higher priorities go first."""
+
+    def __init__(self, file):
+        self.file = str(file)
+        self.paths = dict()
+        self.patterns = []
+        self.cache = dict()
+        with open(self.file, "r", encoding="utf-8") as tagsp:
+            for num, line in enumerate(tagsp, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    entry = json.loads(line)
+                    tags = (float(entry.get("priority") or 0),
+                            parse_deadline(entry.get("deadline")))
+                    path = entry["file"]
+                except Exception as ex:
+                    raise ValueError("{}:{}: {}".format(self.file, num, ex))
+                if any(c in path for c in "*?["):
+                    self.patterns.append((path, tags))
+                else:
+                    self.paths[os.path.abspath(path)] = tags
+
+    def get(self, file):
+        """(priority, deadline) of a file"""
+        path = os.path.abspath(getattr(file, "path", file))
+        try:
+            return self.cache[path]
+        except KeyError:
+            pass
+        tags = self.paths.get(path)
+        if tags is None:
+            name = os.path.basename(path)
+            tags = next((t for p, t in self.patterns
+                         if fnmatch(path, os.path.abspath(p)) or fnmatch(name, p)),
+                        (0.0, INF))
+        self.cache[path] = tags
+        return tags
+
+
+class Policy:
+    """Order of jobs in the queue: first come first served (fifo), shortest
+    or longest files first, by priority tags, or by deadline tags. Priority
+    tags count for all but deadline, which puts them second."""
+
+    def __init__(self, name="fifo", tags=None):
+        if name not in POLICIES:
+            raise ValueError("Unknown scheduling policy {}".format(name))
+        self.name = name
+        self.tags = tags
+
+    def key(self, job, seq):
+        """Sort key of a job queued as the seq-th"""
+        priority, deadline = self.tags.get(job.file) if self.tags else (0.0, INF)
+        if self.name == "deadline":
+            return (deadline, -priority, seq)
+        if self.name == "priority":
+            return (-priority, deadline, seq)
+        if self.name == "shortest":
+            return (-priority, job.file.size, seq)
+        if self.name == "longest":
+            return (-priority, -job.file.size, seq)
+        return (-priority, seq)
+
+
+class Job:
+    """A file waiting in line to get pushed"""
+
+    __slots__ = ("file", "item", "attempt", "due", "rooms")
+
+    def __init__(self, file, item):
+        self.file = file
+        self.item = item
+        self.attempt = 0
+        self.due = 0.0
+        # Rooms still to upload to, if not all of them
+        self.rooms = None
+
+    def __repr__(self):
+        return "<Job({!r}, {})>".format(self.file, self.item)
+
+
+class WorkQueue:
+    """Thread-safe queue feeding upload workers, in the order of a policy"""
+
+    def __init__(self, jobs=(), maxsize=0, policy=None):
+        self.cond = threading.Condition()
+        self.policy = policy or Policy()
+        self.seq = count()
+        # Heap of jobs to do now, by policy
+        self.ready = []
+        # Heap of retries to do later, by due time
+        self.delayed = []
+        self.maxsize = maxsize
+        self.closed = False
+        for job in jobs:
+            self.push(job)
+
+    def __len__(self):
+        with self.cond:
+            return len(self.ready) + len(self.delayed)
+
+    def push(self, job):
+        """Queue a job, with the lock held"""
+        seq = next(self.seq)
+        if job.due > time.monotonic():
+            heappush(self.delayed, (job.due, seq, job))
+        else:
+            heappush(self.ready, (self.policy.key(job, seq), seq, job))
+
+    def put(self, job):
+        """Add a job to the queue, waiting for room in bounded queues"""
+        with self.cond:
+            while self.maxsize and len(self.ready) + len(self.delayed) >= self.maxsize \
+                    and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                raise ValueError("Queue closed")
+            self.push(job)
+            self.cond.notify_all()
+
+    def requeue(self, job, delay=0.0):
+        """Put a failed job back in line, to be retried no sooner than delay
+        seconds from now; first come first served puts it at the end. Works
+        on closed queues, too."""
+        with self.cond:
+            job.due = time.monotonic() + delay
+            self.push(job)
+            self.cond.notify_all()
+
+    def close(self):
+        """No more jobs will be added; workers drain and quit"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def drop(self):
+        """Close the queue and throw away everything still in it, so that
+        workers quit once done with what they have. Returns the number of
+        jobs dropped."""
+        with self.cond:
+            dropped = len(self.ready) + len(self.delayed)
+            self.ready, self.delayed = [], []
+            self.closed = True
+            self.cond.notify_all()
+            return dropped
+
+    def get(self):
+        """Get the next job, or None if the queue is closed and drained"""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, seq, job = heappop(self.delayed)
+                    heappush(self.ready, (self.policy.key(job, seq), seq, job))
+                if self.ready:
+                    job = heappop(self.ready)[2]
+                    self.cond.notify_all()
+                    return job
+                if self.delayed:
+                    # Only retries that are not due yet
+                    self.cond.wait(self.delayed[0][0] - now)
+                elif self.closed:
+                    return None
+                else:
+                    self.cond.wait()
+
+
+def run_workers(queue, jobs, work):
+    """Run work(job) for everything in the queue using jobs workers.
+    A single worker runs inline, so behavior stays the same as ever.
+    Exceptions escaping work() stop the batch and are re-raised here."""
+
+    errors = []
+
+    def worker():
+        """Process jobs until the queue runs dry"""
+        while not errors:
+            job = queue.get()
+            if job is None:
+                return
+            try:
+                work(job)
+            except BaseException as ex:
+                errors.append(ex)
+                queue.close()
+                return
+
+    if jobs <= 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker, name="upload-{}".format(i), daemon=True)
+                   for i in range(jobs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # Join with a timeout, so that the main thread still receives
+            # KeyboardInterrupt
+            while thread.is_alive():
+                thread.join(0.25)
+    if errors:
+        raise errors[0]
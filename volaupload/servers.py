@@ -0,0 +1,150 @@
+""" RealDolos' funky volafile upload tool (Server selection)"""
+
+# pylint: disable=broad-except
+
+import json
+import socket
+import sys
+import threading
+import time
+
+from .stat import FAC
+from .utils import save_json
+
+# Seconds probe results and measured rates stay valid
+TTL = 6 * 3600
+
+# Seconds a server that turned out to be slow is avoided
+PENALTY = 1800
+
+# Seconds an upload may take to get up to speed
+GRACE = 15
+
+# Accept servers doing at least this fraction of the best known rate
+RATE_FRACTION = 0.5
+
+# Accept servers with at most this multiple of the best known latency
+LATENCY_FACTOR = 3.0
+
+# Stop being picky after rejecting this many upload keys
+MAX_REJECTS = 5
+
+# Uploads smaller than this do not say much about a server's rate
+MIN_SAMPLE = 1 << 22
+
+# Weight of new rate samples
+ALPHA = 0.3
+
+
+class SlowServer(Exception):
+    """The server is too slow, try another one"""
+    pass
+
+
+def probe_latency(server, port=443, timeout=2.0):
+    """Seconds it takes to connect to a server, or None"""
+    start = time.monotonic()
+    try:
+        with socket.create_connection((server, port), timeout=timeout):
+            return time.monotonic() - start
+    except Exception:
+        return None
+
+
+class ServerRanking:
+    """Ranks upload servers by connect latency and measured upload rates,
+    steering uploads away from slow ones"""
+
+    def __init__(self, file, ttl=TTL, min_rate=None):
+        self.file = str(file)
+        self.ttl = ttl
+        self.min_rate = min_rate
+        self.lock = threading.Lock()
+        try:
+            with open(self.file, "r") as serverp:
+                self.servers = json.load(serverp)
+        except FileNotFoundError:
+            self.servers = dict()
+        except Exception as ex:
+            print("Ignoring broken server cache {}: {}".format(self.file, ex),
+                  file=sys.stderr, flush=True)
+            self.servers = dict()
+
+    def get(self, server):
+        """Cached information about a server, probing it when stale"""
+        now = time.time()
+        with self.lock:
+            entry = self.servers.setdefault(server, dict())
+            stale = now - entry.get("probed", 0) > self.ttl
+        if stale:
+            latency = probe_latency(server)
+            with self.lock:
+                entry["latency"] = latency
+                entry["probed"] = now
+                if now - entry.get("measured", 0) > self.ttl:
+                    entry.pop("rate", None)
+        return entry
+
+    def _best(self, key, pick):
+        """Best known value of key among servers not penalized"""
+        now = time.time()
+        values = [e[key] for e in self.servers.values()
+                  if e.get(key) is not None and e.get("penalized", 0) < now]
+        return pick(values) if values else None
+
+    def accept(self, server, rejections=0):
+        """Decide whether to upload to a server we were offered"""
+        entry = self.get(server)
+        if rejections >= MAX_REJECTS:
+            return True
+        with self.lock:
+            if entry.get("penalized", 0) > time.time():
+                return False
+            if entry.get("latency") is None:
+                # Cannot even connect, which is fine when no server can be
+                # probed at all (e.g. behind a proxy)
+                return self._best("latency", min) is None
+            rate, best_rate = entry.get("rate"), self._best("rate", max)
+            if rate is not None and best_rate:
+                return rate >= best_rate * RATE_FRACTION
+            best_latency = self._best("latency", min)
+            return not best_latency or entry["latency"] <= best_latency * LATENCY_FACTOR
+
+    def record(self, server, rate, size):
+        """Record the byte rate an upload to a server achieved"""
+        if not server or size < MIN_SAMPLE or rate <= 0:
+            return
+        with self.lock:
+            entry = self.servers.setdefault(server, dict())
+            old = entry.get("rate")
+            entry["rate"] = rate if old is None else old + ALPHA * (rate - old)
+            entry["measured"] = time.time()
+
+    def penalize(self, server):
+        """Avoid a server for a while"""
+        with self.lock:
+            self.servers.setdefault(server, dict())["penalized"] = time.time() + PENALTY
+
+    def watch(self, callback):
+        """Progress watcher aborting uploads that stay below the minimum rate"""
+        if not self.min_rate or callback.abort:
+            return
+        stat = callback.stat
+        if stat.runtime < GRACE or callback.cur >= callback.tot:
+            return
+        rate = stat.rate_last * FAC
+        if rate < self.min_rate:
+            server = callback.info.get("server")
+            if server:
+                self.penalize(server)
+            callback.abort = SlowServer("{} is too slow ({:.2f}MB/s)".format(
+                server or "Server", rate / FAC))
+
+    def save(self):
+        """Remember what we learned"""
+        with self.lock:
+            try:
+                save_json(self.file, self.servers)
+            except Exception as ex:
+                print("Failed to write server cache {}: {}".format(self.file, ex),
+                      file=sys.stderr, flush=True)
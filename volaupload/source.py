@@ -0,0 +1,299 @@
+""" RealDolos' funky volafile upload tool (Data sources)"""
+
+# pylint: disable=broad-except
+
+import mmap
+import os
+import threading
+
+from .readahead import PrefetchReader
+from .utils import Reader
+
+HAS_PREAD = hasattr(os, "pread")
+
+
+class ParallelReader(Reader):
+    """File-like reader fetching byte ranges of a file concurrently.
+
+    The upload itself still is a single sequential stream, but the ranges
+    ahead of the current position are read by a pool of threads, so that
+    slow or high-latency storage does not throttle the sender."""
+
+    def __init__(self, file, chunk_size, readers=4, window=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.name = str(file)
+        self.fd = os.open(self.name, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            self.size = os.fstat(self.fd).st_size
+        except Exception:
+            os.close(self.fd)
+            raise
+        self.chunk_size = max(1, chunk_size)
+        self.window = max(readers, window or readers * 2)
+        self.pos = 0
+        self.pending = dict()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, readers),
+                                       thread_name_prefix="reader")
+        self.closed = False
+
+    def fileno(self):
+        """File descriptor of the underlying file"""
+        return self.fd
+
+    def _seek(self, offset):
+        """Move, dropping read-ahead outside the window"""
+        self.pos = offset
+        first = offset // self.chunk_size
+        for idx in list(self.pending):
+            if idx < first or idx >= first + self.window:
+                self.pending.pop(idx).cancel()
+
+    def _fetch(self, idx):
+        """Read a chunk, in a reader thread"""
+        return os.pread(self.fd, self.chunk_size, idx * self.chunk_size)
+
+    def _schedule(self, first):
+        """Make sure the window starting at first is being read"""
+        last = min(first + self.window, (self.size - 1) // self.chunk_size + 1)
+        for idx in range(first, last):
+            if idx not in self.pending:
+                self.pending[idx] = self.pool.submit(self._fetch, idx)
+
+    def read(self, size=-1):
+        """Read up to size bytes, from at most one chunk"""
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self.pos >= self.size:
+            return b""
+        idx, offset = divmod(self.pos, self.chunk_size)
+        self._schedule(idx)
+        data = self.pending[idx].result()
+        if size is None or size < 0:
+            size = len(data) - offset
+        end = offset + size
+        if offset == 0 and end >= len(data):
+            chunk = data
+        else:
+            chunk = data[offset:end]
+        if not chunk:
+            # Short file, someone truncated it under us
+            return b""
+        self.pos += len(chunk)
+        if self.pos // self.chunk_size != idx:
+            del self.pending[idx]
+        return chunk
+
+    def close(self):
+        """Stop readers and close the file"""
+        if self.closed:
+            return
+        self.closed = True
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.pool.shutdown(wait=True)
+        os.close(self.fd)
+
+
+class MappedSource(Reader):
+    """File-like reader over a memory mapping of a file.
+
+    Reads hand out memoryview slices of the mapping instead of copying
+    data into freshly allocated buffers. Touching pages of a mapping past
+    the end of a file that shrank kills the process with SIGBUS, so reads
+    make sure the file is still large enough first. That still leaves a
+    window until the slice is sent, which is why mapping is opt-in."""
+
+    def __init__(self, file):
+        self.name = str(file)
+        self.fp = open(self.name, "rb", buffering=0)
+        try:
+            self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.fp.close()
+            raise
+        if hasattr(self.map, "madvise"):
+            try:
+                self.map.madvise(mmap.MADV_SEQUENTIAL)
+            except Exception:
+                pass
+        self.view = memoryview(self.map)
+        self.size = len(self.map)
+        self.pos = 0
+        self.closed = False
+
+    def fileno(self):
+        """File descriptor of the underlying file"""
+        return self.fp.fileno()
+
+    def read(self, size=-1):
+        """Read up to size bytes, as a view into the mapping"""
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if size is None or size < 0:
+            size = self.size
+        start = min(self.pos, self.size)
+        end = min(self.size, start + size)
+        if end > start and os.fstat(self.fp.fileno()).st_size < end:
+            raise OSError("{} shrank while uploading it".format(self.name))
+        self.pos = end
+        return self.view[start:end]
+
+    def readinto(self, buf):
+        """Read into a preallocated buffer"""
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        """Unmap and close the file"""
+        if self.closed:
+            return
+        self.closed = True
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Somebody still holds a slice; the mapping goes away with it
+            pass
+        self.fp.close()
+
+
+class SharedFile:
+    """A file read once for uploads of it to several rooms at the same time.
+
+    Blocks read for one upload are kept around for the others, as long as
+    they are within window bytes of the furthest block read. Uploads
+    falling further behind than that read on their own instead of holding
+    everybody else back."""
+
+    def __init__(self, file, block_size, window=64 << 20):
+        self.name = str(file)
+        self.fd = os.open(self.name, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            self.size = os.fstat(self.fd).st_size
+        except Exception:
+            os.close(self.fd)
+            raise
+        self.block_size = max(block_size, 1 << 16)
+        self.keep = max(2, window // self.block_size)
+        self.cond = threading.Condition()
+        self.blocks = dict()
+        self.loading = set()
+        self.top = -1
+        self.refs = 0
+        self.disk = 0
+
+    def _pread(self, idx):
+        """Read a block from disk"""
+        offset = idx * self.block_size
+        if HAS_PREAD:
+            data = os.pread(self.fd, self.block_size, offset)
+        else:
+            with self.cond:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                data = os.read(self.fd, self.block_size)
+        self.disk += len(data)
+        return data
+
+    def block(self, idx):
+        """Get a block, reading it unless another upload did already"""
+        with self.cond:
+            while idx in self.loading:
+                self.cond.wait()
+            data = self.blocks.get(idx)
+            if data is not None:
+                return data
+            shared = idx > self.top - self.keep
+            if shared:
+                self.loading.add(idx)
+        if not shared:
+            # Lagging way behind
+            return self._pread(idx)
+        data = b""
+        try:
+            data = self._pread(idx)
+        finally:
+            with self.cond:
+                self.loading.discard(idx)
+                if data:
+                    self.blocks[idx] = data
+                    if idx > self.top:
+                        self.top = idx
+                        for old in [i for i in self.blocks if i <= idx - self.keep]:
+                            del self.blocks[old]
+                self.cond.notify_all()
+        return data
+
+    def open(self):
+        """A reader of its own for another upload"""
+        with self.cond:
+            self.refs += 1
+        return SharedReader(self)
+
+    def release(self):
+        """A reader is done; the last one closes the file"""
+        with self.cond:
+            self.refs -= 1
+            if self.refs:
+                return
+            self.blocks.clear()
+        os.close(self.fd)
+
+
+class SharedReader(Reader):
+    """File-like reader over a SharedFile"""
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.name = shared.name
+        self.size = shared.size
+        self.pos = 0
+        self.closed = False
+
+    def fileno(self):
+        """File descriptor of the underlying file"""
+        return self.shared.fd
+
+    def read(self, size=-1):
+        """Read up to size bytes, from at most one block"""
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self.pos >= self.size:
+            return b""
+        idx, offset = divmod(self.pos, self.shared.block_size)
+        data = self.shared.block(idx)
+        if size is None or size < 0:
+            size = len(data) - offset
+        if offset == 0 and size >= len(data):
+            chunk = data
+        else:
+            chunk = memoryview(data)[offset:offset + size]
+        self.pos += len(chunk)
+        return chunk
+
+    def close(self):
+        """Let go of the shared file"""
+        if self.closed:
+            return
+        self.closed = True
+        self.shared.release()
+
+
+def open_source(file, block_size, split_threshold=None, readers=4, mapped=False,
+                prefetch=False, drop=False):
+    """Open a file for uploading, using concurrent range readers for
+    files at least split_threshold in size, a prefetcher, or memory
+    mapping it"""
+    if split_threshold and HAS_PREAD and file.size >= split_threshold and readers > 1:
+        return ParallelReader(file, max(block_size, 1 << 20), readers)
+    if prefetch:
+        return PrefetchReader(file, block_size, drop)
+    if mapped:
+        try:
+            return MappedSource(file)
+        except (ValueError, OSError):
+            # Empty files and special files cannot be mapped
+            pass
+    return open(file, "rb", buffering=block_size)
@@ -1,28 +1,79 @@
 """ RealDolos' funky volafile upload tool (Stats)"""
 
-from datetime import datetime
+import math
+import time
+
+from collections import deque
 
 
 FAC = 1024.0 * 1024.0
 
+NS = 1e9
+
+# Seconds of samples the sliding window rate covers
+WINDOW = 5.0
+
+# Seconds the smoothed rate takes to follow a change by ~63%
+TAU = 3.0
+
+# Block latencies kept for percentiles
+LATENCIES = 1024
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    rank = max(0, math.ceil(pct / 100.0 * len(values)) - 1)
+    return values[min(rank, len(values) - 1)]
+
 
 class Statistics:
-    """Keep some statistics"""
+    """Keep some statistics: average, sliding window and smoothed rates,
+    and how long blocks take to go out"""
 
-    def __init__(self):
-        self.start = datetime.now()
-        self.lasts = [(self.start, 0)]
+    def __init__(self, window=WINDOW, tau=TAU):
+        self.window = int(window * NS)
+        self.tau = tau
+        self.start = time.monotonic_ns()
+        self.lasts = deque(((self.start, 0),))
+        self.ewma = None
+        self.latencies = deque(maxlen=LATENCIES)
+        self.last_block = None
+        self.blocks = 0
 
     def record(self, pos):
         """Record a position in time"""
-        self.lasts += (datetime.now(), pos),
-        if len(self.lasts) > 10:
-            self.lasts.pop(0)
+        now = time.monotonic_ns()
+        last, lpos = self.lasts[-1]
+        lasts = self.lasts
+        lasts.append((now, pos))
+        # Keep one sample at or beyond the window edge, so the window is
+        # always covered
+        while len(lasts) > 2 and now - lasts[1][0] >= self.window:
+            lasts.popleft()
+        elapsed = (now - last) / NS
+        if elapsed > 0:
+            current = (pos - lpos) / elapsed
+            if self.ewma is None:
+                self.ewma = current
+            else:
+                self.ewma += (1 - math.exp(-elapsed / self.tau)) * (current - self.ewma)
+
+    def block(self):
+        """Record that another block went out"""
+        now = time.monotonic_ns()
+        self.blocks += 1
+        if self.last_block is not None:
+            self.latencies.append((now - self.last_block) / NS)
+        self.last_block = now
 
     @property
     def time(self):
-        """Last time recorded"""
-        return self.lasts[-1][0]
+        """Last time recorded, in monotonic seconds"""
+        return self.lasts[-1][0] / NS
 
     @property
     def pos(self):
@@ -32,7 +83,7 @@ class Statistics:
     @property
     def runtime(self):
         """Total runtime so far"""
-        return (self.time - self.start).total_seconds()
+        return (self.lasts[-1][0] - self.start) / NS
 
     @property
     def brate(self):
@@ -47,18 +98,50 @@ class Statistics:
         """Total avg. megabyterate so far"""
         return self.brate / FAC
 
-    def eta(self, total):
-        """Estimated time of arrival"""
+    @property
+    def wrate(self):
+        """Byterate over the sliding window"""
+        (first, fpos), (last, lpos) = self.lasts[0], self.lasts[-1]
         try:
-            return (total - self.pos) / self.brate
+            return (lpos - fpos) * NS / (last - first)
         except ZeroDivisionError:
             return 0.0
 
     @property
     def rate_last(self):
-        """Avg. megabyterate over the last samples"""
-        diff = (self.time - self.lasts[0][0]).total_seconds()
+        """Avg. megabyterate over the sliding window"""
+        return self.wrate / FAC
+
+    @property
+    def srate(self):
+        """Smoothed byterate"""
+        return self.ewma or 0.0
+
+    def eta(self, total):
+        """Estimated time of arrival, by the smoothed rate so that it does not
+        jump around too much"""
+        rate = self.srate or self.brate
         try:
-            return (self.pos - self.lasts[0][1]) / FAC / diff
+            return max(0.0, (total - self.pos) / rate)
         except ZeroDivisionError:
             return 0.0
+
+    def latency(self, pcts=PERCENTILES):
+        """Percentiles of block latencies, in seconds"""
+        values = sorted(list(self.latencies))
+        return {"p{}".format(p): percentile(values, p) for p in pcts}
+
+    def snapshot(self, total=None):
+        """Machine readable state of things, rates in bytes per second"""
+        snap = dict(runtime=self.runtime,
+                    pos=self.pos,
+                    rate=self.brate,
+                    rate_window=self.wrate,
+                    rate_smoothed=self.srate,
+                    blocks=self.blocks,
+                    idle=(time.monotonic_ns() - (self.last_block or self.start)) / NS,
+                    latency=self.latency())
+        if total is not None:
+            snap["total"] = total
+            snap["eta"] = self.eta(total)
+        return snap
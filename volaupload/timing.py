@@ -0,0 +1,197 @@
+""" RealDolos' funky volafile upload tool (Profiling)"""
+
+# pylint: disable=broad-except
+
+import json
+import sys
+import threading
+import time
+
+NS = 1e9
+
+# Stages timed while sending, each excluding the stages nested in it
+STAGES = ("read", "throttle", "hash", "callback")
+
+
+class UploadProfile:
+    """Where the time of a single upload went"""
+
+    def __init__(self, file, room):
+        self.file = str(file)
+        self.room = room
+        self.times = dict.fromkeys(STAGES, 0)
+        self.counts = dict.fromkeys(STAGES, 0)
+        self.stack = []
+        self.start = time.monotonic_ns()
+        self.first = self.last = self.end = None
+        self.size = 0
+        self.ok = False
+
+    def enter(self):
+        """Start timing a stage"""
+        now = time.monotonic_ns()
+        if self.first is None:
+            self.first = now
+        self.stack.append(now)
+
+    def leave(self, stage):
+        """Stop timing a stage"""
+        now = time.monotonic_ns()
+        elapsed = now - self.stack.pop()
+        self.times[stage] += elapsed
+        self.counts[stage] += 1
+        if self.stack:
+            # Do not count it for the outer stage, too
+            self.stack[-1] += elapsed
+        if stage == "callback":
+            self.last = now
+
+    def summary(self):
+        """Breakdown in seconds"""
+        end = self.end or time.monotonic_ns()
+        first = self.first or end
+        last = max(self.last or first, first)
+        staged = sum(self.times.values())
+        summary = dict(file=self.file, room=self.room, size=self.size, ok=self.ok,
+                       total=(end - self.start) / NS,
+                       setup=(first - self.start) / NS,
+                       send=max(0, last - first - staged) / NS,
+                       server=(end - last) / NS,
+                       blocks=self.counts["callback"])
+        summary.update((k, v / NS) for k, v in self.times.items())
+        summary["rate"] = self.size / summary["total"] if summary["total"] else 0.0
+        return summary
+
+
+class Timed:
+    """File-like wrapper of an upload source, timing reads as a stage"""
+
+    def __init__(self, source, profile, stage="read"):
+        self.source = source
+        self.profile = profile
+        self.stage = stage
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _extype, _value, _traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def read(self, size=-1):
+        """Read, timing it"""
+        self.profile.enter()
+        try:
+            return self.source.read(size)
+        finally:
+            self.profile.leave(self.stage)
+
+    def close(self):
+        """Close the source"""
+        self.source.close()
+
+
+class RunProfile:
+    """Collects upload profiles of a run, and the time workers spent between
+    files, writing a JSON breakdown and optionally cProfile statistics"""
+
+    def __init__(self, file=None, stats=None):
+        self.file = file
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = time.monotonic_ns()
+        self.uploads = []
+        self.between = 0
+        self.retries = 0
+        self.profilers = []
+
+    def begin(self, file, room):
+        """Start profiling an upload"""
+        return UploadProfile(file, room)
+
+    def end(self, profile, size, ok=True):
+        """Done with an upload, for better or worse"""
+        profile.end = time.monotonic_ns()
+        profile.size, profile.ok = size, ok
+        with self.lock:
+            self.uploads.append(profile)
+
+    def retry(self):
+        """Account for a file going back into the queue"""
+        with self.lock:
+            self.retries += 1
+
+    def wrap(self, func):
+        """Profile a worker function: the time each worker spends between
+        calls, and optionally the calls themselves under cProfile, with a
+        profiler per thread"""
+        if self.stats:
+            import cProfile
+
+        def profiled(*args, **kw):
+            """func, profiled"""
+            local = self.local
+            last = getattr(local, "last", None)
+            if last is not None:
+                with self.lock:
+                    self.between += time.monotonic_ns() - last
+            profiler = getattr(local, "profiler", None)
+            if self.stats and profiler is None:
+                profiler = local.profiler = cProfile.Profile()
+                with self.lock:
+                    self.profilers.append(profiler)
+            try:
+                if profiler:
+                    try:
+                        profiler.enable()
+                    except ValueError:
+                        # Some Pythons profile one thread at a time only
+                        profiler = None
+                return func(*args, **kw)
+            finally:
+                if profiler:
+                    profiler.disable()
+                local.last = time.monotonic_ns()
+
+        return profiled
+
+    def summary(self):
+        """Per-file and per-run breakdown"""
+        with self.lock:
+            uploads = [u.summary() for u in self.uploads]
+            between, retries = self.between, self.retries
+        keys = ("total", "setup",) + STAGES + ("send", "server")
+        run = {k: sum(u[k] for u in uploads) for k in keys}
+        run.update(wall=(time.monotonic_ns() - self.start) / NS,
+                   between=between / NS,
+                   uploads=len(uploads),
+                   failed=sum(not u["ok"] for u in uploads),
+                   retries=retries,
+                   bytes=sum(u["size"] for u in uploads if u["ok"]))
+        return dict(run=run, uploads=uploads)
+
+    def write(self):
+        """Write the breakdown, and the cProfile statistics"""
+        if self.file:
+            try:
+                if self.file == "-":
+                    json.dump(self.summary(), sys.stderr, indent=2)
+                    print(file=sys.stderr, flush=True)
+                else:
+                    with open(self.file, "w") as profilep:
+                        json.dump(self.summary(), profilep, indent=2)
+            except Exception as ex:
+                print("Failed to write profile to {}: {}".format(self.file, ex),
+                      file=sys.stderr, flush=True)
+        if self.stats and self.profilers:
+            import pstats
+
+            try:
+                stats = pstats.Stats(*self.profilers)
+                stats.dump_stats(self.stats)
+            except Exception as ex:
+                print("Failed to write profiler statistics to {}: {}".format(self.stats, ex),
+                      file=sys.stderr, flush=True)
@@ -0,0 +1,86 @@
+""" RealDolos' funky volafile upload tool (Block size tuning)"""
+
+# pylint: disable=broad-except
+
+import json
+import random
+import sys
+import threading
+
+from .utils import save_json
+
+MIN_BLOCK_SIZE = 1 << 16
+MAX_BLOCK_SIZE = 1 << 26
+
+# Uploads shorter than this many blocks say more about latency than
+# about the block size
+MIN_BLOCKS = 8
+
+# Weight of new samples
+ALPHA = 0.3
+
+# Probability of exploring a neighboring block size once both are known
+EXPLORE = 0.15
+
+
+class BlockSizeTuner:
+    """Pick block sizes per server by hill-climbing on measured rates.
+    Rates are remembered between runs."""
+
+    def __init__(self, file, default):
+        self.file = str(file)
+        self.default = min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, default))
+        self.lock = threading.Lock()
+        self.last_server = None
+        try:
+            with open(self.file, "r") as tunep:
+                self.servers = json.load(tunep)
+        except FileNotFoundError:
+            self.servers = dict()
+        except Exception as ex:
+            print("Ignoring broken block size cache {}: {}".format(self.file, ex),
+                  file=sys.stderr, flush=True)
+            self.servers = dict()
+
+    def rates(self, server):
+        """Known rates by block size for a server"""
+        return {int(k): v for k, v in self.servers.get(server, dict()).items()}
+
+    def choose(self, server=None):
+        """Choose a block size for the next upload to server.
+        The server usually is not known before the upload starts, in that
+        case the most recently used one is assumed."""
+        with self.lock:
+            server = server or self.last_server
+            rates = self.rates(server) if server else dict()
+            if not rates:
+                return self.default
+            best = max(rates, key=rates.get)
+            neighbors = [bs for bs in (best // 2, best * 2)
+                         if MIN_BLOCK_SIZE <= bs <= MAX_BLOCK_SIZE]
+            unknown = [bs for bs in neighbors if bs not in rates]
+            if unknown:
+                return unknown[0]
+            if neighbors and random.random() < EXPLORE:
+                return random.choice(neighbors)
+            return best
+
+    def record(self, server, block_size, rate, size):
+        """Record the average byte rate an upload achieved"""
+        if not server or size < block_size * MIN_BLOCKS or rate <= 0:
+            return
+        with self.lock:
+            self.last_server = server
+            rates = self.servers.setdefault(server, dict())
+            key = str(block_size)
+            old = rates.get(key)
+            rates[key] = rate if old is None else old + ALPHA * (rate - old)
+
+    def save(self):
+        """Remember the rates"""
+        with self.lock:
+            try:
+                save_json(self.file, self.servers)
+            except Exception as ex:
+                print("Failed to write block size cache {}: {}".format(self.file, ex),
+                      file=sys.stderr, flush=True)
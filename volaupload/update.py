@@ -0,0 +1,106 @@
+""" RealDolos' funky volafile upload tool (Updates)"""
+
+# pylint: disable=broad-except
+
+import sys
+import threading
+import time
+
+from configparser import ConfigParser
+
+from ._version import __version__
+from .utils import CONFIG
+
+UPDATE_INFO = "https://api.github.com/repos/RealDolos/volaupload/tags"
+
+# Seconds between checks
+UPDATE_INTERVAL = 86400
+
+# Give up on GitHub after that many seconds
+UPDATE_TIMEOUT = 5.0
+
+
+def update_state():
+    """The config and its [update] section, remembering the last check"""
+    config = ConfigParser()
+    try:
+        config.read(CONFIG)
+        try:
+            section = config["update"]
+        except Exception:
+            config.add_section("update")
+            section = config["update"]
+    except Exception:
+        section = dict()
+    return config, section
+
+
+def update_notice(ver, url):
+    """Tell about a new version, if ver is newer than this one"""
+    try:
+        newer = ([int(i) for i in ver.replace("v", "").split(".")] >
+                 [int(i) for i in __version__.split(".")])
+    except ValueError:
+        return None
+    if not newer or not url:
+        return None
+    return "New version {} available:\nInstall: pip3 install -U {}".format(ver, url)
+
+
+def check_update(timeout=UPDATE_TIMEOUT):
+    """Ask GitHub if there is a new version, remembering the answer"""
+    import requests
+
+    config, section = update_state()
+    ver = requests.get(UPDATE_INFO, timeout=timeout).json()[0]
+    url = ver["zipball_url"]
+    ver = ver["name"]
+    section["check"] = str(time.time())
+    section["version"] = ver
+    section["url"] = url
+    with open(CONFIG, "w") as configfile:
+        config.write(configfile)
+    return update_notice(ver, url)
+
+
+class UpdateCheck(threading.Thread):
+    """Checks for a new version in the background, so that nobody has to
+    wait for GitHub"""
+
+    def __init__(self, timeout=UPDATE_TIMEOUT):
+        super().__init__(name="update-check", daemon=True)
+        self.timeout = timeout
+        self.notice = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.notice = check_update(self.timeout)
+        except Exception as ex:
+            self.error = ex
+
+    def start(self):
+        super().start()
+        return self
+
+    def report(self):
+        """Print what the check found, if it finished already"""
+        if self.is_alive():
+            return
+        if self.error:
+            print("Failed to check for new version:", self.error,
+                  file=sys.stderr, flush=True)
+        elif self.notice:
+            print(self.notice, flush=True)
+
+
+def start_update_check():
+    """Print what the last check found, checking again in the background
+    once a day. Returns the background check, if any."""
+    _, section = update_state()
+    if float(section.get("check", 0)) + UPDATE_INTERVAL >= time.time():
+        notice = update_notice(section.get("version", __version__), section.get("url", None))
+        if notice:
+            print(notice, flush=True)
+        return None
+    return UpdateCheck().start()
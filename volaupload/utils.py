@@ -2,35 +2,59 @@
 
 # pylint: disable=broad-except
 
+import json
 import math
+import os
 import re
 import sys
 
+from contextlib import contextmanager
+from functools import lru_cache
+
 # pylint: disable=no-name-in-module
 try:
-    from os import posix_fadvise, POSIX_FADV_WILLNEED
+    from os import posix_fadvise, POSIX_FADV_WILLNEED, POSIX_FADV_DONTNEED
 except ImportError:
     def posix_fadvise(*args, **kw):
         """Mock implementation for systems not supporting it"""
         args, kw = args, kw
 
     POSIX_FADV_WILLNEED = 0
+    POSIX_FADV_DONTNEED = 0
 # pylint: enable=no-name-in-module
 
+CONFIG = os.path.expanduser(os.path.join("~", ".vola.conf"))
+
+
+NATSORT_NUMBERS = re.compile(r"\d+")
+
+
+def natsort_number(match):
+    """Encode a run of digits so that it compares by its numeric value"""
+    digits = match.group().lstrip("0") or "0"
+    return "\x01" + chr(len(digits)) + digits
+
 
 def natsort(val):
-    """Returns a tuple from a string that can be used as a sort key for
-    natural sorting."""
-    return [int(i) if i.isdigit() else i for i in re.split(r"(\d+)", val)]
+    """Returns a string that can be used as a sort key for natural sorting.
+    Plain strings compare a lot faster than lists of strings and ints."""
+    return NATSORT_NUMBERS.sub(natsort_number, val)
+
+
+@lru_cache(maxsize=1 << 14)
+def natsort_dir(val):
+    """natsort for directories, which many files share"""
+    return natsort(str(val))
 
 
 def to_name(file):
     """Sortkey by-name"""
-    return natsort(file.name.casefold()), natsort(file.parent)
+    return natsort(file.name.casefold()) + "\x00" + natsort_dir(file.parent)
+
 
 def to_path(file):
     """Sortkey by-path"""
-    return natsort(file.casefold())
+    return natsort(str(file).casefold())
 
 
 def to_size(file):
@@ -43,28 +67,133 @@ SORTING = dict(name=to_name,
                size=to_size)
 
 
+def cache_dir():
+    """Directory to keep caches and journals in"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join("~", ".cache")
+    return os.path.join(os.path.expanduser(base), "volaupload")
+
+
+@contextmanager
+def lock_file(file):
+    """Hold an exclusive lock on file.lock, so that processes sharing file
+    take turns updating it. No locking where the OS lacks flock."""
+    os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open("{}.lock".format(file), "a") as lockp:
+        fcntl.flock(lockp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockp.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def atomic_write(file, **kw):
+    """Write a temporary file replacing file once complete, so that nobody
+    ever reads a partial one"""
+    os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+    tmp = "{}.{}.tmp".format(file, os.getpid())
+    try:
+        with open(tmp, "w", **kw) as outp:
+            yield outp
+        os.replace(tmp, file)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def save_json(file, data):
+    """Atomically replace file with data as JSON"""
+    with atomic_write(file) as outp:
+        json.dump(data, outp)
+
+
+class Reader:
+    """Base of the file-like readers uploads are sent from. Subclasses keep
+    the current position in pos and the size in size, and implement read(),
+    close() and, for seeks needing more than moving pos, _seek()"""
+
+    pos = 0
+    size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _extype, _value, _traceback):
+        self.close()
+
+    def readable(self):
+        """Yes, it is"""
+        return True
+
+    def seekable(self):
+        """Yes, it is"""
+        return True
+
+    def tell(self):
+        """Current position"""
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Seek to a new position"""
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self._seek(offset)
+        return self.pos
+
+    def _seek(self, offset):
+        """Move to a valid offset"""
+        self.pos = offset
+
+    def close(self):
+        """Nothing to close"""
+        pass
+
+
 def try_unlink(file):
     """Attempt to unlink a file, or else print an error"""
     try:
-        file.unlink()
+        os.unlink(file)
     except Exception as ex:
         print("Failed to delete file after upload: {}, {}".
               format(file, ex),
               file=sys.stderr, flush=True)
 
 
-def try_advise(file, offset, length):
-    """Try to advise the OS on what file data is needed next"""
+def try_advise(file, offset, length, advice=POSIX_FADV_WILLNEED):
+    """Try to advise the OS on what file data is needed next (or not)"""
     try:
         if hasattr(file, "fileno"):
             posix_fadvise(file.fileno(),
                           offset,
                           length,
-                          POSIX_FADV_WILLNEED)
+                          advice)
     except Exception as ex:
         print(ex, file=sys.stderr, flush=True)
 
 
+SIZE_UNITS = dict(k=1 << 10, m=1 << 20, g=1 << 30, t=1 << 40)
+
+
+def parse_size(size):
+    """Parse human readable sizes such as 512K, 64M or 4G into bytes"""
+    size = str(size).strip().lower().rstrip("ib")
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
 def shorten(string, length):
     """Shorten a string to a specific length, cropping in the middle"""
     len2 = length // 2
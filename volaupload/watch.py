@@ -0,0 +1,363 @@
+""" RealDolos' funky volafile upload tool (Watch folders)"""
+
+# pylint: disable=broad-except
+
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from stat import S_ISREG
+
+from .discover import Discovery
+from .discover import FileRecord
+from .utils import atomic_write
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE)
+
+EVENT = struct.Struct("iIII")
+
+# Seconds a file has to stay unchanged before it is considered complete
+SETTLE = 1.0
+
+# Seconds between scans, when inotify is not available
+POLL = 2.0
+
+# Files the command line refuses to upload
+REFUSED = ("Thumbs.db",)
+
+# Lines the state log may have beyond what is pending and uploaded before
+# it is rewritten
+COMPACT_SLACK = 1000
+
+
+class Inotify:
+    """Bare bones inotify, through libc"""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = dict()
+
+    def add(self, directory):
+        """Watch a directory"""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "Cannot watch {}".format(directory))
+        self.dirs[wd] = directory
+
+    def read(self, timeout):
+        """Wait for events, returning (mask, path) pairs"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            directory = self.dirs.get(wd)
+            if mask & IN_Q_OVERFLOW:
+                events.append((mask, None))
+            elif directory and name:
+                events.append((mask, os.path.join(directory, os.fsdecode(name))))
+        return events
+
+    def close(self):
+        """Stop watching"""
+        os.close(self.fd)
+
+
+class Watcher(Discovery):
+    """Discovery that never ends: uploads what is in a directory, then keeps
+    picking up files as they are completed, remembering what is pending and
+    what went up already across restarts.
+
+    The state is a log of JSON lines, appended to as files are queued and
+    done, and rewritten with just what is still needed once it grew too
+    long. Files that are gone are forgotten."""
+
+    def __init__(self, directory, state, recurse=False, workers=4, settle=SETTLE):
+        super().__init__([directory], recurse=True, workers=workers)
+        self.directory = str(directory)
+        self.deep = recurse
+        self.settle = settle
+        self.state = str(state)
+        self.lock = threading.RLock()
+        self.queued = set()
+        self.settling = dict()
+        self.sink = None
+        self.inotify = None
+        self.seen = None
+        self.refused = set()
+        self.log = None
+        self.lines = 0
+        self.backlog, self.uploaded = self.load()
+        self.compact()
+
+    def load(self):
+        """Replay the state log, returning what was pending and uploaded"""
+        pending, uploaded = dict(), dict()
+        try:
+            with open(self.state, "r", encoding="utf-8", errors="surrogateescape") as statep:
+                for line in statep:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # Torn last line of a run that died
+                        continue
+                    if "op" not in event:
+                        # The whole state in one go, like it used to be
+                        pending.update(dict.fromkeys(event["pending"]))
+                        uploaded.update(event["uploaded"])
+                        continue
+                    path = event["path"]
+                    if event["op"] == "queued":
+                        pending[path] = None
+                        continue
+                    pending.pop(path, None)
+                    uploaded.pop(path, None)
+                    if event["op"] == "uploaded":
+                        uploaded[path] = [event["size"], event["mtime"]]
+        except FileNotFoundError:
+            pass
+        except Exception as ex:
+            print("Ignoring broken watch state {}: {}".format(self.state, ex),
+                  file=sys.stderr, flush=True)
+        return list(pending), uploaded
+
+    def compact(self):
+        """Rewrite the state log with just what is pending and uploaded,
+        forgetting files that are gone"""
+        with self.lock:
+            if self.log:
+                self.log.close()
+                self.log = None
+            self.uploaded = {k: v for k, v in self.uploaded.items() if os.path.exists(k)}
+            pending = sorted(self.queued.union(self.backlog))
+            try:
+                with atomic_write(self.state, encoding="utf-8",
+                                  errors="surrogateescape") as statep:
+                    for path in pending:
+                        statep.write(json.dumps(dict(op="queued", path=path)) + "\n")
+                    for path, (size, mtime) in self.uploaded.items():
+                        statep.write(json.dumps(dict(op="uploaded", path=path,
+                                                     size=size, mtime=mtime)) + "\n")
+                self.log = open(self.state, "a", encoding="utf-8", errors="surrogateescape")
+                self.lines = len(pending) + len(self.uploaded)
+            except Exception as ex:
+                print("Failed to write watch state {}: {}".format(self.state, ex),
+                      file=sys.stderr, flush=True)
+
+    def record(self, op, path, **kw):
+        """Append a change to the state log, rewriting it once it grew too long"""
+        with self.lock:
+            if self.lines > 2 * (len(self.queued) + len(self.uploaded)) + COMPACT_SLACK:
+                self.compact()
+            if not self.log:
+                return
+            try:
+                self.log.write(json.dumps(dict(op=op, path=path, **kw)) + "\n")
+                self.log.flush()
+                self.lines += 1
+            except Exception as ex:
+                print("Failed to write watch state {}: {}".format(self.state, ex),
+                      file=sys.stderr, flush=True)
+
+    def forget(self, path):
+        """A file is gone, so there is no need to remember it anymore"""
+        path = os.path.abspath(path)
+        with self.lock:
+            self.settling.pop(path, None)
+            if self.uploaded.pop(path, None) is not None:
+                self.record("dropped", path)
+
+    def scan(self, directory, sink):
+        if self.inotify:
+            # Watch first, so that nothing slips through while scanning
+            try:
+                self.inotify.add(directory)
+            except OSError as ex:
+                print(ex, file=sys.stderr, flush=True)
+        subdirs = super().scan(directory, sink)
+        return subdirs if self.deep else []
+
+    def known(self, path, record):
+        """Is the file queued or did it go up already?"""
+        return path in self.queued or self.uploaded.get(path) == [record.size, record.mtime]
+
+    def refuse(self, path):
+        """Skip files the command line would refuse, instead of dying on
+        them. Says so once per file."""
+        if os.path.basename(path) not in REFUSED:
+            return False
+        with self.lock:
+            if path in self.refused:
+                return True
+            self.refused.add(path)
+        print("Not uploading {}".format(path), file=sys.stderr, flush=True)
+        return True
+
+    def found(self, record):
+        """Queue a file, unless it is queued or went up already"""
+        with self.lock:
+            path = os.path.abspath(record.path)
+            if self.refuse(path):
+                # Possibly queued by an older version
+                self.record("dropped", path)
+                return
+            if self.known(path, record):
+                return
+            self.queued.add(path)
+            self.record("queued", path)
+        self.sink(record)
+
+    def consider(self, record):
+        """Let a file found by scanning settle down, unless it is known"""
+        if record.name.startswith("."):
+            return
+        with self.lock:
+            path = os.path.abspath(record.path)
+            if self.refuse(path):
+                return
+            if self.seen is not None:
+                self.seen.add(path)
+            if path not in self.settling and not self.known(path, record):
+                self.settling[path] = (record.size, record.mtime,
+                                       time.monotonic() + self.settle)
+
+    def done(self, file, uploaded=True):
+        with self.lock:
+            path = os.path.abspath(file)
+            self.queued.discard(path)
+            if uploaded and os.path.exists(path):
+                self.uploaded[path] = [file.size, file.mtime]
+                self.record("uploaded", path, size=file.size, mtime=file.mtime)
+            else:
+                self.uploaded.pop(path, None)
+                self.record("dropped", path)
+
+    def wait(self, path):
+        """Wait for a file to settle down before uploading it"""
+        if os.path.basename(path).startswith("."):
+            # Most likely something still being written
+            return
+        if self.refuse(os.path.abspath(path)):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self.lock:
+            self.settling[os.path.abspath(path)] = (stat.st_size, stat.st_mtime,
+                                   time.monotonic() + self.settle)
+
+    def check(self):
+        """Upload files that settled down"""
+        now = time.monotonic()
+        with self.lock:
+            due = [(p, s) for p, s in self.settling.items() if s[2] <= now]
+            for path, _ in due:
+                del self.settling[path]
+        for path, (size, mtime, _) in due:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if not S_ISREG(stat.st_mode):
+                continue
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self.wait(path)
+                continue
+            self.found(FileRecord(path, stat.st_size, stat.st_mtime))
+
+    def timeout(self, default):
+        """Seconds until the next file settles, or default if sooner"""
+        with self.lock:
+            if not self.settling:
+                return default
+            due = max(0.0, min(s[2] for s in self.settling.values()) - time.monotonic())
+        return due if default is None else min(default, due)
+
+    def walk(self, directory=None):
+        """Scan the whole directory, or a new subdirectory, for files"""
+        if directory is None:
+            with self.lock:
+                self.seen = set()
+            Discovery.run(self, self.consider)
+            with self.lock:
+                # Whatever a full walk did not come across is likely gone
+                gone = [p for p in self.uploaded if p not in self.seen]
+                self.seen = None
+            for path in gone:
+                if not os.path.exists(path):
+                    self.forget(path)
+            return
+        with self.cond:
+            self.dirs.append(directory)
+            self.pending += 1
+        self.walker(self.consider)
+
+    def run(self, sink):
+        """Upload what was pending or is there already, then watch"""
+        self.sink = sink
+        try:
+            self.inotify = Inotify()
+        except Exception as ex:
+            print("Cannot use inotify, polling instead: {}".format(ex),
+                  file=sys.stderr, flush=True)
+        backlog, self.backlog = self.backlog, []
+        for path in backlog:
+            try:
+                self.found(FileRecord.stat(path))
+            except OSError:
+                with self.lock:
+                    self.record("dropped", path)
+        self.walk()
+        print("Watching {} for new files...".format(self.directory), flush=True)
+        try:
+            while not self.error:
+                if not self.inotify:
+                    time.sleep(self.timeout(POLL))
+                    self.walk()
+                else:
+                    for mask, path in self.inotify.read(self.timeout(None)):
+                        if path is None:
+                            # Missed events
+                            self.walk()
+                        elif mask & (IN_DELETE | IN_MOVED_FROM):
+                            if not mask & IN_ISDIR:
+                                self.forget(path)
+                        elif not mask & IN_ISDIR:
+                            self.wait(path)
+                        elif mask & (IN_CREATE | IN_MOVED_TO) and self.deep:
+                            self.walk(path)
+                self.check()
+        finally:
+            if self.inotify:
+                self.inotify.close()
+            with self.lock:
+                if self.log:
+                    self.log.close()
+                    self.log = None